@@ -60,6 +60,13 @@ def load_files():
                 scp.put('src/tracker.py', 'tracker.py')
                 scp.put('src/network_utils.py', 'network_utils.py')
                 scp.put('src/blockchain.py', 'blockchain.py')
+                scp.put('src/miner.py', 'miner.py')
+                scp.put('src/codec.py', 'codec.py')
+                scp.put('src/store.py', 'store.py')
+                scp.put('src/transport.py', 'transport.py')
+                scp.put('src/mempool.py', 'mempool.py')
+                scp.put('src/health.py', 'health.py')
+                scp.put('src/bootstrap.py', 'bootstrap.py')
                 scp.put('src/review_client.py', 'review_client.py')
                 scp.put('logo.png', 'logo.png')
                 stdin, stdout, stderr = ssh.exec_command("chmod +x *")
@@ -5,27 +5,317 @@
 # blockchain.py -
 #
 
+import os
+import re
 import typing
+import codecs
 import struct
 import hashlib
 import time
 import json
+import itertools
+import collections
+from concurrent.futures import Executor
+
+# block hash covers to_bytes(), i.e. the header fields and the whole payload
+LEGACY_VERSION = 1
+# block hash covers only the fixed 76-byte header, data is bound by merkle_hash
+HEADER_VERSION = 2
+# same header as HEADER_VERSION, difficulty holds a compact-bits target
+COMPACT_VERSION = 3
+# version used for newly created blocks
+BLOCK_VERSION = COMPACT_VERSION
+BLOCK_VERSIONS = (LEGACY_VERSION, HEADER_VERSION, COMPACT_VERSION)
+
+HEADER_SIZE = 76
+# id, timestamp, difficulty and nonce are packed as uint32
+UINT32_MAX = 0xFFFFFFFF
+EMPTY_HASH = int(0).to_bytes(32, "big")
+
+# every hash satisfies this target, used for the genesis block
+MAX_TARGET = (1 << 256) - 1
+# compact encoding of 2^256, which saturates to MAX_TARGET when decoded
+MAX_BITS = 0x21010000
+
+# seconds the difficulty retargeting aims for between consecutive blocks
+BLOCK_INTERVAL = 10
+# number of recent blocks whose timestamps drive the next target
+RETARGET_WINDOW = 10
+# largest factor the target may move by relative to the window average
+MAX_ADJUSTMENT = 4
+# a block's time must exceed the median time of this many previous blocks
+MEDIAN_TIME_SPAN = 11
+# and may not be further than this many seconds ahead of our clock
+MAX_FUTURE_DRIFT = 2 * 60 * 60
+
+# side branches forking off deeper than this below the tip are dropped
+MAX_REORG_DEPTH = 100
+
+# blocks per task handed to a validation worker, see verify_parallel
+VERIFY_CHUNK = 256
+# chunks verified at a time, twice the miner's default number of workers
+VERIFY_IN_FLIGHT = 2 * (os.cpu_count() or 1)
+
+# size of the pieces a json chain is read in, see iter_json_blocks
+STREAM_CHUNK = 16 * 1024
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def bits_to_target(bits: int) -> int:
+    """
+    Decode a compact-bits difficulty (as in Bitcoin's nBits) to a target.
+
+    The top byte is the target's size in bytes and the low 3 bytes are its
+    most significant digits. Negative targets decode to 0 (never satisfied).
+    """
+    size = bits >> 24
+    mantissa = bits & 0x7FFFFF
+
+    if bits & 0x800000:
+        return 0
+
+    if size <= 3:
+        target = mantissa >> (8 * (3 - size))
+    else:
+        target = mantissa << (8 * (size - 3))
+
+    return min(target, MAX_TARGET)
+
+
+def target_to_bits(target: int) -> int:
+    """
+    Encode a target in compact-bits form, rounding down to 3 significant bytes.
+    """
+    if target >= MAX_TARGET:
+        return MAX_BITS
+
+    size = (target.bit_length() + 7) // 8
+
+    if size <= 3:
+        mantissa = target << (8 * (3 - size))
+    else:
+        mantissa = target >> (8 * (size - 3))
+
+    # keep the sign bit clear
+    if mantissa & 0x800000:
+        mantissa >>= 8
+        size += 1
+
+    return (size << 24) | mantissa
+
+
+def zeros_to_target(zeros: int) -> int:
+    """
+    Target equivalent to requiring a number of leading zeros in the hex hash.
+    """
+    return (1 << max(0, 256 - 4 * zeros)) - 1
+
+
+def target_work(target: int) -> int:
+    """
+    Expected number of hashes needed to meet a target.
+    """
+    return (1 << 256) // (target + 1)
+
+
+# layout of a block's data, as produced by json.dumps({"data": [...]})
+DATA_PREFIX = b'{"data": ['
+DATA_SEPARATOR = b", "
+DATA_SUFFIX = b"]}"
+
+_decoder = json.JSONDecoder()
+
+
+class MerkleTree:
+    def __init__(self, msgs: list[bytes] = ()):
+        """
+        Build a Merkle tree bottom-up over a list of bytes objects.
+
+        Adjacent hashes are paired and hashed level by level, and an unpaired
+        last hash is carried up to the next level as is. Every level is kept,
+        so appending a leaf only recomputes the path to the root.
+        """
+        level = [hashlib.sha256(m).digest() for m in msgs]
+        self.levels = [level]
+
+        while len(level) > 1:
+            level = [
+                hashlib.sha256(level[i] + level[i + 1]).digest()
+                if i + 1 < len(level)
+                else level[i]
+                for i in range(0, len(level), 2)
+            ]
+            self.levels.append(level)
+
+    def __len__(self) -> int:
+        return len(self.levels[0])
+
+    def root(self) -> bytes:
+        """
+        Merkle root, or b"" for an empty tree.
+        """
+        return self.levels[-1][0] if self.levels[0] else b""
+
+    def append(self, msg: bytes):
+        """
+        Add a leaf, recomputing only the O(log n) hashes above it.
+        """
+        node = hashlib.sha256(msg).digest()
+        index = len(self.levels[0])
+        self.levels[0].append(node)
+        depth = 0
+
+        while len(self.levels[depth]) > 1:
+            if index % 2 == 1:
+                node = hashlib.sha256(
+                    self.levels[depth][index - 1] + node).digest()
+            index //= 2
+            depth += 1
+
+            if depth == len(self.levels):
+                self.levels.append([])
+
+            parent = self.levels[depth]
+            if index == len(parent):
+                parent.append(node)
+            else:
+                parent[index] = node
+
+    def proof(self, index: int) -> list[tuple[bytes, bool]]:
+        """
+        Merkle audit path for the leaf at index, from the bottom up.
+
+        Returns a list of (sibling hash, whether the sibling is on the left).
+        Levels where the node is carried up unpaired have no entry.
+        """
+        path = []
+
+        for level in self.levels[:-1]:
+            if index % 2 == 1:
+                path.append((level[index - 1], True))
+            elif index + 1 < len(level):
+                path.append((level[index + 1], False))
+            index //= 2
+
+        return path
+
+    def split_node(self, start: int, stop: int) -> bytes:
+        """
+        Hash of the leaves in [start, stop) as the original recursive merkle()
+        computed it: split at the middle (rounding down) and hash both halves.
+        """
+        if stop - start == 1:
+            return self.levels[0][start]
+
+        mid = start + (stop - start) // 2
+        return hashlib.sha256(
+            self.split_node(start, mid) + self.split_node(mid, stop)).digest()
+
+    def split_root(self) -> bytes:
+        """
+        Merkle root that version 1 blocks commit to (see split_node).
+        """
+        return self.split_node(0, len(self)) if self.levels[0] else b""
+
+    def split_proof(self, index: int) -> list[tuple[bytes, bool]]:
+        """
+        Like proof(), but for split_root().
+        """
+        path = []
+        start, stop = 0, len(self)
+
+        while stop - start > 1:
+            mid = start + (stop - start) // 2
+            if index < mid:
+                path.append((self.split_node(mid, stop), False))
+                stop = mid
+            else:
+                path.append((self.split_node(start, mid), True))
+                start = mid
+
+        path.reverse()
+        return path
+
+    def block_root(self, version: int) -> bytes:
+        """
+        Merkle root a block of the given version commits to.
+        """
+        return self.split_root() if version == LEGACY_VERSION else self.root()
+
+    def block_proof(self, version: int, index: int) -> list[tuple[bytes, bool]]:
+        """
+        Audit path for the leaf at index against block_root(version).
+        """
+        if version == LEGACY_VERSION:
+            return self.split_proof(index)
+        return self.proof(index)
 
 
 def merkle(msgs: list[bytes]) -> bytes:
     """
     Computes Merkle tree root of arbitrary list of bytes objects.
     """
-    n = len(msgs)
+    return MerkleTree(msgs).root()
+
+
+def verify_proof(msg: bytes, path: list[tuple[bytes, bool]], root: bytes) -> bool:
+    """
+    Check a Merkle audit path (see MerkleTree.proof) for msg against a root.
+    """
+    node = merkle([msg])
+
+    for sibling, is_left in path:
+        if is_left:
+            node = hashlib.sha256(sibling + node).digest()
+        else:
+            node = hashlib.sha256(node + sibling).digest()
+
+    return node == root
+
+
+def pack_reviews(reviews: list[bytes]) -> bytes:
+    """
+    Build block data from already serialized reviews, without parsing them.
+    """
+    return DATA_PREFIX + DATA_SEPARATOR.join(reviews) + DATA_SUFFIX
+
+
+def unpack_reviews(data: bytes) -> list[bytes] | None:
+    """
+    Split block data back into the serialized reviews (the Merkle leaves) it
+    was built from, by slicing rather than re-serializing them.
+
+    Returns None if data is not laid out as pack_reviews/json.dumps would.
+    """
+    # json.dumps escapes non-ascii, which also makes str and bytes offsets agree
+    if (
+        not data.isascii()
+        or not data.startswith(DATA_PREFIX)
+        or not data.endswith(DATA_SUFFIX)
+    ):
+        return None
+
+    text = data.decode()
+    pos = len(DATA_PREFIX)
+    end = len(text) - len(DATA_SUFFIX)
+    reviews = []
 
-    if n == 0:
-        return b""
+    while pos < end:
+        try:
+            _, stop = _decoder.raw_decode(text, pos)
+        except ValueError:
+            return None
+
+        reviews.append(data[pos:stop])
 
-    if n == 1:
-        return hashlib.sha256(msgs[0]).digest()
+        if stop == end:
+            return reviews
+        if not data.startswith(DATA_SEPARATOR, stop):
+            return None
+        pos = stop + len(DATA_SEPARATOR)
 
-    return hashlib.sha256(
-        merkle(msgs[: n // 2]) + merkle(msgs[n // 2:])).digest()
+    # either no reviews at all, or a trailing separator
+    return None if reviews else reviews
 
 
 class Block:
@@ -33,11 +323,12 @@ class Block:
         self,
         id: int = 0,
         timestamp: int = int(time.time()),
-        difficulty: int = 3,  # number of leading zeros in hex
+        difficulty: int = MAX_BITS,  # compact target, see bits_to_target
         merkle_hash: bytes = int(0).to_bytes(32, "big"),
         nonce: int = 0,
         prev_hash: bytes = int(0).to_bytes(32, "big"),
         data: bytes = b"",
+        version: int = BLOCK_VERSION,
     ):
         """
         Initialize blockchain block.
@@ -45,10 +336,13 @@ class Block:
         arguments:
         id -- (uint32) height of block in tree
         timestamp -- (uint32) epoch time of when block was mined
-        difficulty -- (uint32) number of 0s in hash when computing nonce
+        difficulty -- (uint32) compact-bits target the hash must not exceed
+                      (number of leading 0s in the hex hash before version 3)
         merkle_hash -- (bytes[32]) hash of Merkle tree root for data
         nonce -- (uint32) nonce value used for showing proof-of-work
         prev_hash -- (bytes[32]) hash of previous node in blockchain
+        data -- (bytes) block payload
+        version -- (uint32) hashing and difficulty rule, see *_VERSION
         """
         self.id = id
         self.timestamp = timestamp
@@ -57,6 +351,7 @@ class Block:
         self.nonce = nonce
         self.prev_hash = prev_hash
         self.data = data
+        self.version = version
 
         self.hash = b""
 
@@ -72,13 +367,26 @@ class Block:
             "nonce": self.nonce,
             "prev_hash": self.prev_hash.hex(),
             "data": self.data.hex(),
+            "version": self.version,
         }
 
+    def header_dict(self) -> dict:
+        """
+        Like to_dict(), but without the data for blocks whose hash does not
+        depend on it.
+        """
+        d = self.to_dict()
+        if self.version != LEGACY_VERSION:
+            del d["data"]
+        return d
+
     def from_dict(self, d: dict) -> bool:
         """
         Initialize block values from dict.
 
-        Returns whether Block values are valid.
+        Returns whether Block values are valid: the numeric fields must be
+        integers that fit in a uint32, so that the block can be packed and
+        hashed.
         """
         try:
             self.id = d["id"]
@@ -87,18 +395,22 @@ class Block:
             self.merkle_hash = bytes.fromhex(d["merkle_hash"])
             self.nonce = d["nonce"]
             self.prev_hash = bytes.fromhex(d["prev_hash"])
-            self.data = bytes.fromhex(d["data"])
+            # headers (see header_dict) may leave out the data
+            self.data = bytes.fromhex(d.get("data", ""))
+            # chains from before versioning carry no version field
+            self.version = d.get("version", LEGACY_VERSION)
 
             if (
-                self.id < 0
-                or self.timestamp < 0
-                or self.difficulty < 0
+                not all(
+                    type(value) is int and 0 <= value <= UINT32_MAX
+                    for value in (self.id, self.timestamp, self.difficulty, self.nonce)
+                )
                 or len(self.merkle_hash) != 32
-                or self.nonce < 0
                 or len(self.prev_hash) != 32
+                or self.version not in BLOCK_VERSIONS
             ):
                 return False
-        except KeyError:
+        except (KeyError, TypeError, ValueError, AttributeError):
             return False
 
         return True
@@ -118,117 +430,892 @@ class Block:
         )
         return struct.pack(f"!III32sI32s{len(self.data)}s", *header_data)
 
+    def header(self) -> bytes:
+        """
+        Pack the fixed-size block header, which commits to the data only
+        through merkle_hash. The nonce comes last so that the hash state of
+        the first 72 bytes can be reused across nonces.
+        """
+        return struct.pack(
+            "!32s32sIII",
+            self.prev_hash,
+            self.merkle_hash,
+            self.timestamp,
+            self.difficulty,
+            self.nonce,
+        )
+
+    def header_parts(self) -> tuple[bytes, bytes]:
+        """
+        Split the hashed bytes around the nonce, so miners only need to
+        hash the prefix once and the nonce (plus suffix) on each attempt.
+        """
+        if self.version == LEGACY_VERSION:
+            prefix = struct.pack(
+                "!III32s", self.id, self.timestamp, self.difficulty, self.merkle_hash
+            )
+            return prefix, self.prev_hash + self.data
+
+        return self.header()[: HEADER_SIZE - 4], b""
+
+    def midstate(self):
+        """
+        Hash state after the bytes preceding the nonce.
+        """
+        return hashlib.sha256(self.header_parts()[0])
+
+    def target(self) -> int:
+        """
+        Integer target the block hash must be less than or equal to.
+        """
+        if self.version < COMPACT_VERSION:
+            return zeros_to_target(self.difficulty)
+
+        return bits_to_target(self.difficulty)
+
+    def target_bytes(self) -> bytes:
+        """
+        Target as a 32-byte big-endian string, which compares against a
+        digest the same way the integers would.
+        """
+        return self.target().to_bytes(32, "big")
+
     def compute_hash(self) -> bytes:
-        header = self.to_bytes()
-        return hashlib.sha256(header).digest()
+        if self.version == LEGACY_VERSION:
+            return hashlib.sha256(self.to_bytes()).digest()
+
+        return hashlib.sha256(self.header()).digest()
+
+
+def read_chunks(source, size: int = STREAM_CHUNK):
+    """
+    Yield a document in pieces of size, from a str, a bytes-like object
+    (without copying it whole) or a file-like object.
+    """
+    if hasattr(source, "read"):
+        while chunk := source.read(size):
+            yield chunk
+        return
+
+    if not isinstance(source, str):
+        source = memoryview(source)
+    for i in range(0, len(source), size):
+        chunk = source[i: i + size]
+        yield chunk if isinstance(chunk, str) else bytes(chunk)
+
+
+def iter_json_blocks(chunks):
+    """
+    Decode a json chain (see Blockchain.to_json) one block at a time, as
+    its chunks are read, so that only the block being decoded is held in
+    memory rather than the whole document and its dicts.
+
+    arguments:
+    chunks -- iterable of str or utf-8 bytes pieces of the document (see
+              read_chunks)
+
+    Raises ValueError as soon as the document or a block is malformed.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    # text read but not decoded yet starts at buf[pos]
+    buf, pos = "", 0
+
+    def read_more() -> bool:
+        nonlocal buf, pos
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buf = buf[pos:] + (chunk if isinstance(chunk, str) else utf8.decode(chunk))
+        pos = 0
+        return True
+
+    def peek() -> str | None:
+        # next character after whitespace, None at the end of the document
+        nonlocal pos
+        while True:
+            pos = JSON_WHITESPACE.match(buf, pos).end()
+            if pos < len(buf):
+                return buf[pos]
+            if not read_more():
+                return None
+
+    def expect(chars: str) -> str:
+        nonlocal pos
+        char = peek()
+        if char is None or char not in chars:
+            raise ValueError("invalid blockchain json")
+        pos += 1
+        return char
 
+    def value():
+        # objects and strings end with a delimiter, so a value cut short by
+        # the end of the chunk fails to decode until the rest is read
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+                return obj
+            except json.JSONDecodeError:
+                if not read_more():
+                    raise ValueError("truncated blockchain json")
 
-class Node:
-    def __init__(self, block: Block):
-        self.block = block
-        self.next: Node | None = None
+    expect("{")
+    if value() != "blockchain":
+        raise ValueError("invalid blockchain json")
+    expect(":")
+    expect("[")
+
+    if peek() == "]":
+        pos += 1
+    else:
+        while True:
+            d = value()
+            block = Block()
+            try:
+                valid = isinstance(d, dict) and block.from_dict(d)
+            except (TypeError, AttributeError):
+                valid = False
+            if not valid:
+                raise ValueError("invalid block")
+            yield block
+
+            if expect(",]") == "]":
+                break
+
+    expect("}")
+    if peek() is not None:
+        raise ValueError("trailing data after blockchain json")
+
+
+def check_data(block: Block, headers_only: bool = False) -> MerkleTree | None:
+    """
+    Check a block's data against its merkle hash.
+
+    arguments:
+    block -- the block
+    headers_only -- whether the block comes without data (see header_dict)
+
+    Returns the block's merkle tree, or None if they do not match.
+    """
+    # check if is genesis block
+    if headers_only:
+        return MerkleTree()
+
+    if len(block.data) == 0:
+        # header hashes do not cover the data, so an empty payload must
+        # also commit to an empty tree
+        if block.version != LEGACY_VERSION and block.merkle_hash != EMPTY_HASH:
+            return None
+        return MerkleTree()
+
+    # validate merkle hash/data
+    reviews = unpack_reviews(block.data)
+    if reviews is None:
+        return None
+
+    tree = MerkleTree(reviews)
+    return tree if tree.block_root(block.version) == block.merkle_hash else None
+
+
+def verify_blocks(blocks: list[Block], headers_only: bool = False) -> list:
+    """
+    Checks of each block that do not depend on the rest of the chain, i.e.
+    proof-of-work and merkle hash, so they can run in a worker process.
+
+    Returns the hash of each block, or None for invalid blocks.
+    """
+    hashes = []
+
+    for block in blocks:
+        block_hash = block.compute_hash()
+        if (
+            block_hash > block.target_bytes()
+            or check_data(block, headers_only) is None
+        ):
+            block_hash = None
+        hashes.append(block_hash)
+
+    return hashes
+
+
+def verify_parallel(
+    blocks,
+    executor: Executor,
+    headers_only: bool = False,
+    in_flight: int = VERIFY_IN_FLIGHT,
+):
+    """
+    Run verify_blocks over chunks of VERIFY_CHUNK blocks in an executor,
+    keeping up to in_flight chunks in flight. The next chunk is only read
+    from blocks once the oldest one is done, so at most in_flight chunks
+    are held however long the stream.
+
+    Yields (block, hash or None) in order. Streams shorter than one chunk
+    are verified in this process, where a round trip costs more than it
+    saves.
+    """
+    blocks = iter(blocks)
+    first = list(itertools.islice(blocks, VERIFY_CHUNK))
+
+    if len(first) < VERIFY_CHUNK:
+        yield from zip(first, verify_blocks(first, headers_only))
+        return
+
+    pending = collections.deque(
+        [(first, executor.submit(verify_blocks, first, headers_only))])
+
+    try:
+        while pending:
+            while len(pending) < max(1, in_flight):
+                chunk = list(itertools.islice(blocks, VERIFY_CHUNK))
+                if not chunk:
+                    break
+                pending.append(
+                    (chunk, executor.submit(verify_blocks, chunk, headers_only)))
+
+            chunk, future = pending.popleft()
+            yield from zip(chunk, future.result())
+    finally:
+        # the caller stopped at an invalid block
+        for _, future in pending:
+            future.cancel()
+
+
+class MemoryStore:
+    def __init__(self):
+        """
+        In-memory block storage, the default store of a Blockchain.
+        See store.ChainStore for the persistent one.
+        """
+        # blocks indexed by height (block id)
+        self.blocks: list[Block] = []
+        # total expected hashes from genesis up to and including each block
+        self.work: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def __getitem__(self, height: int | slice) -> Block | list[Block]:
+        return self.blocks[height]
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def hash_at(self, height: int) -> bytes:
+        return self.blocks[height].hash
+
+    def work_at(self, height: int) -> int:
+        return self.work[height]
+
+    def append(self, block: Block, work: int, tree: MerkleTree = None):
+        self.blocks.append(block)
+        self.work.append(work)
+
+    def review_index(self) -> dict:
+        """
+        The dict of review (merkle leaf) hash: (block id, index in block) of
+        the stored blocks' reviews.
+        """
+        index = {}
+        for block in self.blocks:
+            for i, leaf in enumerate(
+                    MerkleTree(unpack_reviews(block.data) or []).levels[0]):
+                index[leaf] = (block.id, i)
+        return index
+
+    def truncate(self, height: int):
+        del self.blocks[height:]
+        del self.work[height:]
 
 
 class Blockchain:
-    def __init__(self, initialize=True):
+    def __init__(
+        self,
+        initialize=True,
+        block_interval: int = BLOCK_INTERVAL,
+        retarget_window: int = RETARGET_WINDOW,
+        headers_only: bool = False,
+        store=None,
+        checkpoints: dict = None,
+    ):
         """
         Initialize blockchain object, optionally loading from json
+
+        arguments:
+        initialize -- whether to start the chain with a genesis block
+        block_interval -- seconds between blocks the difficulty aims for
+        retarget_window -- number of recent blocks used to retarget
+        headers_only -- whether blocks come without data (see header_dict),
+                        in which case their merkle hashes are not checked
+        store -- block storage indexed by height, defaults to a MemoryStore;
+                 a non-empty store.ChainStore reopens a persisted chain
+        checkpoints -- dict of height: block hash the chain must go through,
+                       blocks up to the highest one are assumed valid
+                       (see assume_valid)
         """
-        self.head = None
-        self.tail = None
+        self.store = store if store is not None else MemoryStore()
+        # blocks indexed by height (block id)
+        self.blocks = self.store
+        self.headers_only = headers_only
+        # both indexes are built on first use, so reopening a stored chain
+        # does not read every block
+        # dict of block hash: height
+        self._heights = None
+        # dict of review (merkle leaf) hash: (block id, index in block)
+        self._review_index = None
+        # dict of block hash: (block, cumulative work) for verified blocks
+        # that are not in the chain, i.e. side branches
+        self.branches = {}
+        # blocks removed from the chain by reorgs, for the owner to collect
+        self.disconnected: list[Block] = []
+        self.checkpoints = checkpoints or {}
+        # height up to which blocks were accepted without verifying their
+        # proof and data (see assume_valid and reverify)
+        self.assumed_height = 0
+
+        self.block_interval = block_interval
+        self.retarget_window = retarget_window
 
-        if initialize:
+        if initialize and len(self.store) == 0:
             self.create_genesis_block()
 
-    def to_json(self, indent: int = 0) -> str:
+    @property
+    def heights(self) -> dict:
+        if self._heights is None:
+            self._heights = {
+                self.store.hash_at(h): h for h in range(len(self.store))
+            }
+        return self._heights
+
+    @property
+    def review_index(self) -> dict:
+        if self._review_index is None:
+            self._review_index = {} if self.headers_only else self.store.review_index()
+        return self._review_index
+
+    def index_reviews(self, block: Block, tree: MerkleTree = None):
         """
-        Convert entire blockchain to json format.
+        Add a block's reviews to the review index, if it has been built.
         """
-        chain = []
-        node = self.head
+        if self._review_index is None or self.headers_only:
+            return
+
+        if tree is None:
+            tree = MerkleTree(unpack_reviews(block.data) or [])
+
+        for i, leaf in enumerate(tree.levels[0]):
+            self._review_index[leaf] = (block.id, i)
 
-        while node is not None:
-            chain.append(node.block.to_dict())
-            node = node.next
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def __getitem__(self, height: int | slice) -> Block | list[Block]:
+        """
+        Blocks by height, e.g. blockchain[-1] or blockchain[a:b].
+        """
+        return self.blocks[height]
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def to_json(
+        self,
+        indent: int = 0,
+        headers: bool = False,
+        start: int = 0,
+        stop: int | None = None,
+    ) -> str:
+        """
+        Convert entire blockchain (or the blocks at heights [start, stop)) to
+        json format.
+
+        arguments:
+        indent -- json indentation
+        headers -- whether to leave out block data where possible
+        start -- height of the first block to include
+        stop -- height after the last block to include (defaults to the tip)
+        """
+        if headers:
+            chain = [block.header_dict() for block in self.blocks[start:stop]]
+        else:
+            chain = [block.to_dict() for block in self.blocks[start:stop]]
 
         bc = {"blockchain": chain}
 
         return json.dumps(bc, indent=indent)
 
-    def from_json(self, json_data: str) -> bool:
+    def from_json(self, json_data, executor: Executor = None) -> bool:
         """
         Helper function to initialize the blockchain from a provided json string.
+        Blocks already in the chain are skipped, so this also appends a range
+        of blocks sent in response to a sync request.
+
+        The json is decoded one block at a time (see iter_json_blocks), and
+        each block is verified before the next one is read, or with an
+        executor, at most VERIFY_IN_FLIGHT chunks ahead (see verify_parallel).
+
+        arguments:
+        json_data -- the chain, as from to_json: a str, bytes-like object or
+                     file-like object
+        executor -- optional process pool to verify blocks in (see load)
 
         Returns whether inputted values are
         """
-        bc = json.loads(json_data)["blockchain"]
+        return self.load(iter_json_blocks(read_chunks(json_data)), executor)
 
-        for node_dict in bc:
-            # verify blockchain
-            new_block = Block()
-            if not new_block.from_dict(node_dict) or not self.add_block(
-                new_block, new_block.compute_hash()
-            ):
+    def load(self, blocks, executor: Executor = None) -> bool:
+        """
+        Verify and accept blocks in order, skipping those already known.
+        Blocks forking off the chain form a side branch, which the chain
+        switches to if it ends up with more work (see accept_block).
+
+        With an executor, each block's proof-of-work and merkle hash are
+        checked in parallel (see verify_parallel), leaving only the cheap
+        checks that depend on the previous blocks to this process.
+
+        Blocks up to the highest checkpoint are only checked for hash linkage
+        (see assume_valid).
+
+        arguments:
+        blocks -- iterable of Block, which may raise ValueError if malformed
+        executor -- optional process pool to verify blocks in
+
+        Returns whether all blocks were valid.
+        """
+        try:
+            checked = self.check_blocks(blocks, executor)
+            return checked is not None and self.accept_checked(
+                checked, verified=executor is not None
+            )
+        except ValueError:
+            return False
+
+    def check_blocks(self, blocks, executor: Executor = None):
+        """
+        The part of load that does not depend on the chain beyond the
+        checkpoints: accept the blocks that can be assumed valid, and hash
+        (with an executor, fully verify) the rest.
+
+        Returns an iterator of (block, hash or None) to pass to
+        accept_checked, or None if the blocks contradict a checkpoint.
+        Raises ValueError if a block is malformed, possibly while iterating.
+        """
+        blocks = self.assume_valid(blocks)
+        if blocks is None:
+            return None
+
+        if executor is None:
+            return ((block, block.compute_hash()) for block in blocks)
+        return verify_parallel(blocks, executor, self.headers_only)
+
+    def accept_checked(self, checked, verified: bool) -> bool:
+        """
+        Accept blocks from check_blocks in order, skipping those already
+        known (see load).
+
+        arguments:
+        checked -- iterable of (block, hash or None)
+        verified -- whether proof and data were checked (see add_block)
+
+        Returns whether all blocks were valid.
+        """
+        for new_block, proof in checked:
+            if proof is None:
+                return False
+            if self.has_block(proof):
+                continue
+
+            if not self.accept_block(new_block, proof, verified):
                 return False
 
         return True
 
+    def assume_valid(self, blocks):
+        """
+        Accept the blocks leading up to the highest checkpoint by hash linkage
+        alone, without checking their proof-of-work, merkle hash or
+        difficulty: once the last of them hashes to the checkpoint, they are
+        the blocks the network agreed on. reverify can still check them fully
+        later on.
+
+        Nothing is assumed if the chain is already past the checkpoint, or if
+        the blocks do not reach it or do not extend our tip.
+
+        arguments:
+        blocks -- iterable of Block, which may raise ValueError if malformed
+
+        Returns an iterator of the remaining blocks, to be verified as usual,
+        or None if the blocks contradict a checkpoint.
+        """
+        height = max(self.checkpoints, default=0)
+        if height < len(self.blocks):
+            return blocks
+
+        blocks = iter(blocks)
+        prefix = []
+        for block in blocks:
+            prefix.append(block)
+            if block.id >= height:
+                break
+
+        # skip the blocks we already have
+        start = len(self.blocks)
+        new = [block for block in prefix if block.id >= start]
+        tail = self.get_last_block()
+        if (
+            not new
+            or new[-1].id != height
+            or tail is not None
+            and new[0].prev_hash != tail.hash
+        ):
+            return itertools.chain(prefix, blocks)
+
+        prev_hash = new[0].prev_hash
+        for expected_id, block in enumerate(new, start):
+            proof = block.compute_hash()
+            if (
+                block.id != expected_id
+                or block.prev_hash != prev_hash
+                or self.checkpoints.get(block.id, proof) != proof
+            ):
+                return None
+            block.hash = prev_hash = proof
+
+        for block in new:
+            self.append(block)
+        self.assumed_height = height
+
+        return blocks
+
+    def reverify(self, blocks: list[Block] = None, executor: Executor = None):
+        """
+        Fully verify blocks that were assumed valid (see assume_valid), e.g.
+        in the background after bootstrapping, by loading them into a scratch
+        chain without checkpoints.
+
+        arguments:
+        blocks -- the blocks from genesis on, defaults to those up to
+                  assumed_height (pass a copy when running in another thread)
+        executor -- optional process pool to verify blocks in
+
+        Returns the height of the first invalid block, or None if all are
+        valid.
+        """
+        if blocks is None:
+            blocks = self.blocks[: self.assumed_height + 1]
+
+        scratch = Blockchain(
+            initialize=False,
+            block_interval=self.block_interval,
+            retarget_window=self.retarget_window,
+            headers_only=self.headers_only,
+        )
+        if scratch.load(blocks, executor):
+            return None
+        return len(scratch)
+
     def create_genesis_block(self):
         """
         A function to generate genesis block and appends it to the chain.
         The block has index 0, previous_hash as 0, and a valid hash.
         """
-        genesis_block = Block(difficulty=0)
+        genesis_block = Block()
         genesis_block.hash = genesis_block.compute_hash()
-        genesis_node = Node(genesis_block)
-        self.head = genesis_node
-        self.tail = genesis_node
+        self.append(genesis_block)
 
-    def add_block(self, block: Block, proof: bytes) -> bool:
+    def add_block(self, block: Block, proof: bytes, verified: bool = False) -> bool:
         """
         Add the block to the chain after verification.
         Verification includes:
         - Checking if the proof is valid.
         - The previous_hash referred in the block and the hash of latest block
-          in the chain match.
+          in the chain match, and the block id is the next height.
+        - The version is not below the latest block's, so a chain never goes
+          back to an older rule (e.g. version 1 difficulty) once upgraded.
+        - From version 3 on, the difficulty matches the retargeting rule and
+          the timestamp is after the median time past and not too far ahead.
+        - The data matches the merkle hash.
+
+        arguments:
+        block -- the block
+        proof -- the block's hash
+        verified -- whether proof and data were already checked, e.g. by
+                    verify_blocks, leaving only the checks against the chain
         """
+        tail = self.get_last_block()
+
         if (
-            self.tail
+            block.id != len(self.blocks)
+            or self.checkpoints.get(block.id, proof) != proof
+            or tail
             and (
-                self.tail.block.hash != block.prev_hash
-                or block.id != self.tail.block.id + 1
+                tail.hash != block.prev_hash
+                or not self.follows_rules(block, self.recent_blocks(tail.hash))
             )
-            or not self.is_valid_proof(block, proof)
+            or not verified
+            and not self.is_valid_proof(block, proof)
         ):
             return False
 
-        # check if is genesis block
-        if len(block.data) != 0:
-            # validate merkle hash/data
-            data = json.loads(block.data.decode())["data"]
-            computed_merkle = merkle([json.dumps(r).encode() for r in data])
+        if verified:
+            # built lazily by index_reviews if the review index is in use
+            tree = None
+        else:
+            tree = check_data(block, self.headers_only)
+            if tree is None:
+                return False
+
+        block.hash = proof
+        self.append(block, tree)
+
+        return True
+
+    def accept_block(
+        self, block: Block, proof: bytes, verified: bool = False
+    ) -> bool:
+        """
+        Add a block to the chain if it extends the tip, otherwise to a side
+        branch. Side blocks are checked like blocks extending the tip, against
+        the blocks of their own branch (see follows_rules), so that storing
+        one costs as much work as the chain's blocks; the checks are done
+        again when they are applied. A branch with more cumulative work than
+        the chain becomes the chain (see reorg).
+
+        arguments:
+        block -- the block
+        proof -- the block's hash
+        verified -- whether proof and data were already checked (see add_block)
+
+        Returns whether the block was valid (known blocks count as valid).
+        """
+        if self.has_block(proof):
+            return True
 
-            if computed_merkle != block.merkle_hash:
+        tail = self.get_last_block()
+        if tail is None or block.prev_hash == tail.hash:
+            if not self.add_block(block, proof, verified):
                 return False
+            self.prune_branches()
+            return True
+
+        if block.prev_hash in self.heights:
+            parent_id = self.heights[block.prev_hash]
+            parent = self.blocks[parent_id]
+            parent_work = self.store.work_at(parent_id)
+        elif block.prev_hash in self.branches:
+            parent, parent_work = self.branches[block.prev_hash]
+            parent_id = parent.id
+        else:
+            return False
+
+        if (
+            block.id != parent_id + 1
+            or block.id < len(self.blocks) - MAX_REORG_DEPTH
+            or self.checkpoints.get(block.id, proof) != proof
+            or not self.follows_rules(block, self.recent_blocks(block.prev_hash))
+        ):
+            return False
+        if not verified and (
+            not self.is_valid_proof(block, proof)
+            or check_data(block, self.headers_only) is None
+        ):
+            return False
 
         block.hash = proof
-        new_node = Node(block)
+        work = parent_work + target_work(block.target())
+        self.branches[proof] = (block, work)
 
-        if not self.head:
-            self.head = new_node
-        if self.tail:
-            self.tail.next = new_node
-        self.tail = new_node
+        if work > self.chain_work():
+            # the block is dropped if its branch turns out to be invalid
+            if not self.reorg(proof):
+                return False
+            self.prune_branches()
 
         return True
 
+    def reorg(self, tip: bytes) -> bool:
+        """
+        Switch the chain to the side branch ending at tip: roll back to the
+        last block both have in common and apply only the branch's blocks.
+        The rolled back blocks become a side branch themselves, and are added
+        to self.disconnected.
+
+        If a branch block turns out to be invalid on top of its parent (e.g.
+        its difficulty), it is dropped along with the rest of the branch, and
+        the original chain is restored.
+
+        Returns whether the chain was switched.
+        """
+        path = []
+        while tip not in self.heights:
+            block, _ = self.branches[tip]
+            path.append(block)
+            tip = block.prev_hash
+        path.reverse()
+        fork = self.heights[tip] + 1
+
+        works = [self.store.work_at(h) for h in range(fork, len(self.store))]
+        removed = self.truncate(fork)
+        for block in path:
+            del self.branches[block.hash]
+
+        for block in path:
+            # proof and data were checked when the block joined the branch
+            if self.add_block(block, block.hash, verified=True):
+                continue
+
+            # keep the valid part of the branch, and restore the old chain
+            works = [self.store.work_at(h) for h in range(fork, len(self.store))]
+            for applied, work in zip(self.truncate(fork), works):
+                self.branches[applied.hash] = (applied, work)
+            for old in removed:
+                self.append(old)
+            return False
+
+        for old, work in zip(removed, works):
+            self.branches[old.hash] = (old, work)
+        self.disconnected.extend(removed)
+
+        return True
+
+    def prune_branches(self):
+        """
+        Drop side blocks too far below the tip to ever be reorganized onto.
+        """
+        lowest = len(self.blocks) - MAX_REORG_DEPTH
+        for block_hash in [
+            h for h, (block, _) in self.branches.items() if block.id < lowest
+        ]:
+            del self.branches[block_hash]
+
+    def append(self, block: Block, tree: MerkleTree = None):
+        """
+        Store an already verified block (with its hash set) at the next height.
+
+        arguments:
+        block -- the block
+        tree -- the block's merkle tree, if already built
+        """
+        if self._heights is not None:
+            self._heights[block.hash] = len(self.store)
+        if tree is None and self._review_index is not None and not self.headers_only:
+            # built once for both the store and the review index
+            tree = MerkleTree(unpack_reviews(block.data) or [])
+        self.store.append(
+            block, self.chain_work() + target_work(block.target()), tree)
+        self.index_reviews(block, tree)
+
+    def truncate(self, height: int) -> list[Block]:
+        """
+        Remove the blocks at height and above, e.g. to switch to another fork.
+
+        Returns the removed blocks.
+        """
+        removed = self.store[height:]
+        self.store.truncate(height)
+
+        for block in removed:
+            if self._heights is not None:
+                del self._heights[block.hash]
+
+            if self._review_index is not None:
+                for leaf in MerkleTree(unpack_reviews(block.data) or []).levels[0]:
+                    self._review_index.pop(leaf, None)
+
+        return removed
+
+    def recent_blocks(self, block_hash: bytes) -> list[Block]:
+        """
+        The blocks that the difficulty and time of a child of the block with
+        the given hash depend on (see follows_rules), oldest first, ending
+        with that block. It may be in the chain or in a side branch.
+        """
+        count = max(self.retarget_window + 1, MEDIAN_TIME_SPAN)
+        if self.blocks and block_hash == self.store.hash_at(-1):
+            # the tip, without building the heights index
+            return self.blocks[-count:]
+
+        recent = []
+
+        while block_hash in self.branches and len(recent) < count:
+            block, _ = self.branches[block_hash]
+            recent.append(block)
+            block_hash = block.prev_hash
+        recent.reverse()
+
+        missing = count - len(recent)
+        if missing > 0 and block_hash in self.heights:
+            height = self.heights[block_hash]
+            recent = self.blocks[max(0, height + 1 - missing): height + 1] + recent
+
+        return recent
+
+    def follows_rules(self, block: Block, recent: list[Block]) -> bool:
+        """
+        Checks of a block against the blocks before it: its version is not
+        below its parent's, and from version 3 on, its difficulty matches
+        the retargeting rule and its timestamp is after the median time past
+        and not too far ahead.
+
+        arguments:
+        block -- the block
+        recent -- the blocks before it, oldest first (see recent_blocks)
+        """
+        parent = recent[-1]
+        return block.version >= parent.version and (
+            block.version < COMPACT_VERSION
+            or block.difficulty == self.next_bits(recent)
+            and self.median_time_past(recent) < block.timestamp
+            and block.timestamp <= time.time() + MAX_FUTURE_DRIFT
+        )
+
+    def next_bits(self, recent: list[Block] = None) -> int:
+        """
+        Compact target required for the block following the current tail,
+        or the last of the given recent blocks.
+
+        The average target of the last retarget_window blocks is scaled by how
+        long they actually took compared to block_interval per block, limited
+        to a factor of MAX_ADJUSTMENT either way.
+        """
+        if recent is None:
+            recent = self.blocks
+        window = recent[-(self.retarget_window + 1):]
+        tail = window[-1]
+
+        if len(window) < 2:
+            return target_to_bits(tail.target())
+
+        first = window[0]
+        blocks = window[1:]
+        expected = len(blocks) * self.block_interval
+        timespan = tail.timestamp - first.timestamp
+        timespan = max(expected // MAX_ADJUSTMENT, timespan)
+        timespan = min(expected * MAX_ADJUSTMENT, timespan)
+
+        average = sum(b.target() for b in blocks) // len(blocks)
+        return target_to_bits(min(average * timespan // expected, MAX_TARGET))
+
+    def median_time_past(self, recent: list[Block] = None) -> int:
+        """
+        Median timestamp of the last MEDIAN_TIME_SPAN blocks (of the chain,
+        or of the given recent blocks).
+        """
+        if recent is None:
+            recent = self.blocks
+        times = sorted(b.timestamp for b in recent[-MEDIAN_TIME_SPAN:])
+        return times[len(times) // 2]
+
     def is_valid_proof(self, block: Block, block_hash: bytes) -> bool:
         """
         Check if block_hash is valid hash of block and satisfies
         the difficulty criteria.
         """
         return (
-            block_hash.hex().startswith("0" * block.difficulty)
+            block_hash <= block.target_bytes()
             and block_hash == block.compute_hash()
         )
 
@@ -237,17 +1324,119 @@ class Blockchain:
         Mine different values of nonce to get a satisfying hash
         """
         block.nonce = 0
+        midstate = block.midstate()
+        suffix = block.header_parts()[1]
+        target = block.target_bytes()
         computed_hash = block.compute_hash()
 
-        while not computed_hash.hex().startswith("0" * block.difficulty):
+        while computed_hash > target:
             block.nonce += 1
-            computed_hash = block.compute_hash()
+            h = midstate.copy()
+            h.update(block.nonce.to_bytes(4, "big"))
+            h.update(suffix)
+            computed_hash = h.digest()
 
     def get_last_block(self) -> Block:
         """
         Retrive last block
         """
-        return self.tail.block if self.tail else None
+        return self.blocks[-1] if self.blocks else None
+
+    def has_block(self, block_hash: bytes) -> bool:
+        """
+        Whether a block is in the chain or in a side branch.
+        """
+        return block_hash in self.heights or block_hash in self.branches
+
+    def get_block(self, block_hash: bytes) -> Block | None:
+        """
+        Retrieve the block with the given hash, if it is in the chain.
+        """
+        height = self.heights.get(block_hash)
+        return self.blocks[height] if height is not None else None
+
+    def locator(self) -> list[bytes]:
+        """
+        Hashes describing our chain to a peer we sync from: the last 10 blocks,
+        then exponentially further apart, always ending with the genesis block.
+        """
+        hashes = []
+        height = len(self.blocks) - 1
+        step = 1
+
+        while height > 0:
+            hashes.append(self.store.hash_at(height))
+            if len(hashes) >= 10:
+                step *= 2
+            height -= step
+
+        if self.blocks:
+            hashes.append(self.store.hash_at(0))
+
+        return hashes
+
+    def find_fork(self, locator: list[bytes]) -> int:
+        """
+        Height of the first hash in a peer's locator that is also in our
+        chain, i.e. the last block we have in common, or -1 if there is none.
+        """
+        for block_hash in locator:
+            if block_hash in self.heights:
+                return self.heights[block_hash]
+
+        return -1
+
+    def get_block_at(self, height: int) -> Block | None:
+        """
+        Retrieve the block at the given height, if the chain is that long.
+        """
+        return self.blocks[height] if 0 <= height < len(self.blocks) else None
+
+    def prove_review(self, review_hash: bytes) -> dict | None:
+        """
+        Build an inclusion proof for the review with the given (leaf) hash:
+        the header of its block and the Merkle audit path within it.
+
+        Returns None if the review is not in the chain.
+        """
+        if review_hash not in self.review_index:
+            return None
+
+        height, index = self.review_index[review_hash]
+        block = self.get_block_at(height)
+        path = MerkleTree(unpack_reviews(block.data)).block_proof(
+            block.version, index)
+
+        return {
+            "block": block.header_dict(),
+            "index": index,
+            "path": [[sibling.hex(), is_left] for sibling, is_left in path],
+        }
+
+    def verify_review(self, review: bytes, proof: dict) -> bool:
+        """
+        Check an inclusion proof from prove_review against this chain, which
+        only needs to hold the headers.
+        """
+        block = Block()
+
+        try:
+            if not block.from_dict(proof["block"]):
+                return False
+            path = [(bytes.fromhex(h), is_left) for h, is_left in proof["path"]]
+        except (KeyError, TypeError, ValueError):
+            return False
+
+        return self.get_block(block.compute_hash()) is not None and verify_proof(
+            review, path, block.merkle_hash
+        )
+
+    def chain_work(self) -> int:
+        """
+        Cumulative work of the chain, i.e. the expected number of hashes
+        needed to produce all of its blocks.
+        """
+        return self.store.work_at(-1) if len(self.store) else 0
 
 
 if __name__ == "__main__":
@@ -256,11 +1445,14 @@ if __name__ == "__main__":
     start_time = time.time()
 
     for i in range(2):
+        reviews = [json.dumps({"user": "kevvivn", "body": str(i)}).encode()]
         new_block = Block(
             id=i + 1,
-            difficulty=2,
-            prev_hash=bc.tail.block.compute_hash(),
-            data=f"kevvivn{i}".encode(),
+            timestamp=bc.median_time_past() + 1,
+            difficulty=bc.next_bits(),
+            merkle_hash=merkle(reviews),
+            prev_hash=bc.get_last_block().hash,
+            data=pack_reviews(reviews),
         )
         bc.proof_of_work(new_block)
         bc.add_block(new_block, new_block.compute_hash())
@@ -271,8 +1463,6 @@ if __name__ == "__main__":
     if valid and new_bc.to_json() == bc.to_json():
         print(new_bc.to_json(2))
 
-    node = new_bc.head
-    while node is not None:
-        print(node.block.data.decode())
-        node = node.next
+    for block in new_bc:
+        print(block.data.decode())
     print(f"Time taken: {time.time() - start_time}")
@@ -0,0 +1,231 @@
+#
+# Columbia University - CSEE 4119 Computer Network
+# Final Project
+#
+# bootstrap.py -
+#
+
+import collections
+from blockchain import *
+
+# blocks per range request (at most MAX_SYNC_BLOCKS). A peer only sends the
+# blocks that fit in MAX_REPLY_SIZE bytes, see RangeDownload.receive
+RANGE_SIZE = 128
+# ranges requested from a peer at a time
+MAX_IN_FLIGHT = 2
+# seconds before a range request is given to another peer
+RANGE_TIMEOUT = 5.0
+# seconds to wait for a peer's headers
+HEADERS_TIMEOUT = 10.0
+
+
+def verify_headers(payload: bytes, block_interval: int = BLOCK_INTERVAL) -> list | None:
+    """
+    Verify a headers-only chain (see Blockchain.to_json(headers=True)): the
+    proof-of-work, linkage, difficulty and time of every header.
+
+    Returns the hash of the block at each height, or None if invalid.
+    """
+    headers = Blockchain(
+        initialize=False, block_interval=block_interval, headers_only=True
+    )
+    if not headers.from_json(payload):
+        return None
+
+    return [headers.blocks.hash_at(h) for h in range(len(headers))] or None
+
+
+class RangeDownload:
+    def __init__(self, hashes: list[bytes], start: int, range_size: int = RANGE_SIZE):
+        """
+        Download the blocks of a verified header chain in ranges, from
+        several peers at once.
+
+        Ranges are assigned to peers up to MAX_IN_FLIGHT each, and given to
+        another peer if not received within RANGE_TIMEOUT. A peer may send
+        only the first blocks of a range (see MAX_REPLY_SIZE in peer.py), in
+        which case the rest becomes a range of its own. Received blocks must
+        hash to their header's hash, and are handed out in order, as soon as
+        every range before them arrived.
+
+        This class does no I/O: the peer sends the requests it returns and
+        passes on the blocks it receives.
+
+        arguments:
+        hashes -- hash of the block at each height, from verify_headers
+        start -- height of the first block to download
+        range_size -- blocks per range
+        """
+        self.hashes = hashes
+        self.range_size = range_size
+
+        # (first height, count) of the ranges not requested yet, lowest first
+        self.pending = collections.deque(
+            (height, min(range_size, len(hashes) - height))
+            for height in range(start, len(hashes), range_size)
+        )
+        # dict of first height: (count, peer, deadline) of the requested ranges
+        self.in_flight = {}
+        # dict of first height: blocks of the received ranges not handed out
+        self.received = {}
+        # height of the next block to hand out
+        self.next = start
+
+    def done(self) -> bool:
+        return self.next >= len(self.hashes)
+
+    def assign(self, peers: list, now: float) -> list[tuple[int, int, tuple]]:
+        """
+        Assign pending ranges to the peers with free slots, in the given
+        order of preference.
+
+        Returns (first height, count, peer) of each range to request.
+        """
+        load = collections.Counter(peer for _, peer, _ in self.in_flight.values())
+        requests = []
+
+        for peer in peers:
+            while self.pending and load[peer] < MAX_IN_FLIGHT:
+                start, count = self.pending.popleft()
+                self.in_flight[start] = (count, peer, now + RANGE_TIMEOUT)
+                load[peer] += 1
+                requests.append((start, count, peer))
+
+        return requests
+
+    def expire(self, now: float) -> list[tuple]:
+        """
+        Put the ranges that timed out back in front of the pending ones.
+
+        Returns the peers that stalled.
+        """
+        stalled = []
+
+        for start in sorted(self.in_flight, reverse=True):
+            count, peer, deadline = self.in_flight[start]
+            if now >= deadline:
+                del self.in_flight[start]
+                self.pending.appendleft((start, count))
+                if peer not in stalled:
+                    stalled.append(peer)
+
+        return stalled
+
+    def timeout(self, now: float) -> float:
+        """
+        Seconds until the next range request times out.
+        """
+        deadlines = [deadline for _, _, deadline in self.in_flight.values()]
+        return max(0.0, min(deadlines) - now) if deadlines else RANGE_TIMEOUT
+
+    def release(self, peer):
+        """
+        Put every range requested from a peer back in front of the pending
+        ones, e.g. once it sent an invalid one.
+        """
+        for start in sorted(self.in_flight, reverse=True):
+            count, range_peer, _ = self.in_flight[start]
+            if range_peer == peer:
+                del self.in_flight[start]
+                self.pending.appendleft((start, count))
+
+    def receive(self, blocks: list[Block]) -> bool:
+        """
+        Accept the blocks of a range, which may come late from a peer it was
+        taken away from. Blocks past the range are ignored, and the blocks
+        missing at its end are pending again as a new range. Each block must
+        hash to its header's hash. Their data is left to Blockchain.load,
+        which verifies it in parallel, and not at all below a checkpoint.
+
+        Returns False if they do not match the headers.
+        """
+        if not blocks:
+            return False
+
+        start = blocks[0].id
+        if start < self.next or start in self.received:
+            # already received from another peer
+            return True
+
+        if start in self.in_flight:
+            count = self.in_flight[start][0]
+        else:
+            count = next((c for s, c in self.pending if s == start), None)
+            if count is None:
+                return False
+
+        blocks = blocks[:count]
+
+        for height, block in enumerate(blocks, start):
+            block_hash = block.compute_hash()
+            if block.id != height or block_hash != self.hashes[height]:
+                return False
+            block.hash = block_hash
+
+        self.in_flight.pop(start, None)
+        if (start, count) in self.pending:
+            self.pending.remove((start, count))
+        if len(blocks) < count:
+            self.pending.appendleft((start + len(blocks), count - len(blocks)))
+        self.received[start] = blocks
+        return True
+
+    def ready(self) -> list[Block]:
+        """
+        Hand out the received blocks that follow every block handed out so
+        far, in order.
+        """
+        blocks = []
+        while self.next in self.received:
+            chunk = self.received.pop(self.next)
+            blocks.extend(chunk)
+            self.next += len(chunk)
+        return blocks
+
+
+if __name__ == "__main__":
+    import random
+
+    # download 2000 blocks from 4 simulated peers, one of which only sends
+    # the first half of each range, one never answers and one sends
+    # corrupted blocks
+    bc = Blockchain()
+    bc.get_last_block().timestamp = int(time.time()) - 2000 * BLOCK_INTERVAL
+    bc.get_last_block().hash = bc.get_last_block().compute_hash()
+    for i in range(2000):
+        new_block = Block(
+            id=i + 1,
+            timestamp=bc.get_last_block().timestamp + BLOCK_INTERVAL,
+            difficulty=bc.next_bits(),
+            prev_hash=bc.get_last_block().hash,
+        )
+        bc.proof_of_work(new_block)
+        bc.add_block(new_block, new_block.compute_hash())
+
+    hashes = verify_headers(bc.to_json(headers=True).encode())
+    download = RangeDownload(hashes, 0)
+    peers = ["good", "capped", "silent", "corrupt"]
+    order = []
+    now = 0.0
+
+    while not download.done():
+        for peer in download.expire(now):
+            peers.remove(peer)
+        for start, count, peer in download.assign(peers, now):
+            if peer == "silent" or peer not in peers:
+                continue
+            blocks = [Block() for _ in range(count)]
+            for block, original in zip(blocks, bc[start: start + count]):
+                block.from_dict(original.to_dict())
+            if peer == "capped":
+                blocks = blocks[: max(1, count // 2)]
+            if peer == "corrupt":
+                blocks[random.randrange(count)].nonce += 1
+            if not download.receive(blocks):
+                download.release(peer)
+                peers.remove(peer)
+        order.extend(download.ready())
+        now += 1.0
+
+    assert [b.hash for b in order] == hashes
+    print(f"Downloaded {len(order)} blocks, left with peers {peers}")
@@ -0,0 +1,431 @@
+#
+# Columbia University - CSEE 4119 Computer Network
+# Final Project
+#
+# codec.py -
+#
+
+import json
+import bisect
+import struct
+import itertools
+from blockchain import *
+
+# wire formats a requester can ask for
+JSON_FORMAT = 0
+BINARY_FORMAT = 1
+
+# binary payloads start with MAGIC, so they can never be mistaken for json
+MAGIC = b"\xb1\x0c"
+CODEC_VERSION = 1
+
+# kinds of binary payloads
+KIND_BLOCK = 0
+KIND_BLOCKS = 1
+
+# magic, codec version, kind
+ENVELOPE = struct.Struct("!2sBB")
+# number of blocks in a KIND_BLOCKS payload
+COUNT = struct.Struct("!I")
+# version, id, timestamp, difficulty, nonce, prev_hash, merkle_hash, data length
+RECORD = struct.Struct("!BIIII32s32sI")
+
+# json chains are these around the blocks, as json.dumps writes them
+JSON_PREFIX = b'{"blockchain": ['
+JSON_SEPARATOR = b", "
+JSON_SUFFIX = b"]}"
+
+
+def is_binary(payload: bytes) -> bool:
+    """
+    Whether a block or chain payload uses the binary codec (otherwise json).
+    """
+    return payload[: len(MAGIC)] == MAGIC
+
+
+def pack_block(block: Block) -> bytes:
+    """
+    Pack a single block record: fixed-size fields, then the length-prefixed
+    data.
+    """
+    return (
+        RECORD.pack(
+            block.version,
+            block.id,
+            block.timestamp,
+            block.difficulty,
+            block.nonce,
+            block.prev_hash,
+            block.merkle_hash,
+            len(block.data),
+        )
+        + block.data
+    )
+
+
+def record_block(fields: tuple, data: bytes) -> Block:
+    """
+    Build a block from the unpacked fields of its record and its data.
+
+    Raises ValueError if the block version is unknown.
+    """
+    version, id, timestamp, difficulty, nonce, prev_hash, merkle_hash, _ = fields
+    if version not in BLOCK_VERSIONS:
+        raise ValueError("invalid block record")
+
+    return Block(
+        id=id,
+        timestamp=timestamp,
+        difficulty=difficulty,
+        merkle_hash=merkle_hash,
+        nonce=nonce,
+        prev_hash=prev_hash,
+        data=data,
+        version=version,
+    )
+
+
+def unpack_block(view: memoryview, offset: int) -> tuple[Block, int]:
+    """
+    Read the block record at offset without copying the rest of the buffer.
+
+    Returns the block and the offset right after its record.
+    Raises ValueError if the record is truncated or invalid.
+    """
+    try:
+        fields = RECORD.unpack_from(view, offset)
+    except struct.error:
+        raise ValueError("truncated block record")
+
+    offset += RECORD.size
+    size = fields[-1]
+    if offset + size > len(view):
+        raise ValueError("invalid block record")
+
+    return record_block(fields, bytes(view[offset: offset + size])), offset + size
+
+
+def read_exact(stream, size: int) -> bytes:
+    """
+    Read exactly size bytes from a file-like object.
+    """
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("truncated payload")
+    return data
+
+
+def encode_block(block: Block, fmt: int = BINARY_FORMAT) -> bytes:
+    """
+    Encode a single block, e.g. for broadcasting a newly mined one.
+    """
+    if fmt == JSON_FORMAT:
+        return json.dumps(block.to_dict()).encode()
+
+    return ENVELOPE.pack(MAGIC, CODEC_VERSION, KIND_BLOCK) + pack_block(block)
+
+
+def encode_blocks(blocks: list[Block], fmt: int = BINARY_FORMAT) -> bytes:
+    """
+    Encode a sequence of blocks, e.g. a full chain or a sync response.
+    """
+    if fmt == JSON_FORMAT:
+        return json.dumps({"blockchain": [b.to_dict() for b in blocks]}).encode()
+
+    parts = [ENVELOPE.pack(MAGIC, CODEC_VERSION, KIND_BLOCKS), COUNT.pack(len(blocks))]
+    parts.extend(pack_block(b) for b in blocks)
+    return b"".join(parts)
+
+
+def read_envelope(view: memoryview, kind: int) -> int:
+    """
+    Check the envelope of a binary payload and return the offset after it.
+    """
+    try:
+        magic, version, payload_kind = ENVELOPE.unpack_from(view, 0)
+    except struct.error:
+        raise ValueError("truncated payload")
+
+    if magic != MAGIC or version != CODEC_VERSION or payload_kind != kind:
+        raise ValueError("unsupported payload")
+
+    return ENVELOPE.size
+
+
+def decode_block(payload: bytes) -> Block | None:
+    """
+    Decode a single block in either format.
+
+    Returns None if the payload is malformed.
+    """
+    if not is_binary(payload):
+        block = Block()
+        try:
+            return block if block.from_dict(json.loads(payload)) else None
+        except (ValueError, TypeError, AttributeError):
+            return None
+
+    view = memoryview(payload)
+    try:
+        block, end = unpack_block(view, read_envelope(view, KIND_BLOCK))
+    except ValueError:
+        return None
+
+    return block if end == len(view) else None
+
+
+def iter_blocks(payload):
+    """
+    Decode a sequence of blocks in either format, yielding them in order as
+    they are decoded. Passed to Blockchain.load, each block is verified
+    before the next one is decoded, or with an executor, at most
+    VERIFY_IN_FLIGHT chunks ahead, so besides the payload only a bounded
+    number of blocks is held in memory, however long the chain.
+
+    arguments:
+    payload -- a bytes-like object (pass a memoryview to avoid copying a
+               slice of a message), or a binary file-like object
+
+    Raises ValueError if the payload is malformed, which Blockchain.load
+    treats as an invalid chain.
+    """
+    if hasattr(payload, "read"):
+        yield from read_blocks(payload)
+        return
+
+    if not is_binary(payload):
+        yield from iter_json_blocks(read_chunks(payload))
+        return
+
+    view = memoryview(payload)
+    offset = read_envelope(view, KIND_BLOCKS)
+
+    try:
+        (count,) = COUNT.unpack_from(view, offset)
+    except struct.error:
+        raise ValueError("truncated payload")
+    offset += COUNT.size
+
+    for _ in range(count):
+        block, offset = unpack_block(view, offset)
+        yield block
+
+    if offset != len(view):
+        raise ValueError("trailing bytes after blocks")
+
+
+def read_blocks(stream):
+    """
+    Decode a sequence of blocks in either format from a binary file-like
+    object, reading one block at a time (see iter_blocks).
+    """
+    head = stream.read(len(MAGIC))
+    if head != MAGIC:
+        yield from iter_json_blocks(itertools.chain([head], read_chunks(stream)))
+        return
+
+    envelope = head + read_exact(stream, ENVELOPE.size - len(MAGIC))
+    read_envelope(memoryview(envelope), KIND_BLOCKS)
+    (count,) = COUNT.unpack(read_exact(stream, COUNT.size))
+
+    for _ in range(count):
+        fields = RECORD.unpack(read_exact(stream, RECORD.size))
+        yield record_block(fields, read_exact(stream, fields[-1]))
+
+    if stream.read(1):
+        raise ValueError("trailing bytes after blocks")
+
+
+class EncodedChain:
+    def __init__(
+        self, blockchain: Blockchain, fmt: int = BINARY_FORMAT, headers: bool = False
+    ):
+        """
+        Encoding of a chain (see encode_blocks) kept in one append-only
+        buffer, which each new block extends, so that sending the chain or a
+        range of it copies the buffer instead of encoding every block again.
+
+        The buffer follows the chain when it is next used: new blocks are
+        encoded and appended, and the blocks a reorg removed are cut off.
+
+        arguments:
+        blockchain -- the chain
+        fmt -- BINARY_FORMAT or JSON_FORMAT
+        headers -- whether to leave out block data where possible (json
+                   only, see Blockchain.to_json)
+        """
+        self.blockchain = blockchain
+        self.fmt = fmt
+        self.headers = headers
+
+        # block records (binary), or json objects each followed by a
+        # separator, in height order
+        self.buffer = bytearray()
+        # offset in buffer after the block at each height
+        self.ends = []
+        # hash of the block at each height, to notice reorgs
+        self.hashes = []
+
+    def encode_one(self, block: Block) -> bytes:
+        if self.fmt == JSON_FORMAT:
+            d = block.header_dict() if self.headers else block.to_dict()
+            return json.dumps(d).encode() + JSON_SEPARATOR
+        return pack_block(block)
+
+    def overhead(self) -> int:
+        """
+        Bytes of an encoding besides its blocks' encode_one parts.
+        """
+        if self.fmt == JSON_FORMAT:
+            # the separator after the last block is left out
+            return len(JSON_PREFIX) + len(JSON_SUFFIX) - len(JSON_SEPARATOR)
+        return ENVELOPE.size + COUNT.size
+
+    def sync(self):
+        """
+        Cut off the blocks no longer in the chain, and encode the new ones.
+        """
+        store = self.blockchain.blocks
+        height = min(len(self.hashes), len(store))
+        while height > 0 and store.hash_at(height - 1) != self.hashes[height - 1]:
+            height -= 1
+
+        if height < len(self.hashes):
+            del self.buffer[self.ends[height - 1] if height > 0 else 0:]
+            del self.ends[height:]
+            del self.hashes[height:]
+
+        for block in self.blockchain[height:]:
+            self.buffer += self.encode_one(block)
+            self.ends.append(len(self.buffer))
+            self.hashes.append(block.hash)
+
+    def encode(
+        self, start: int = 0, stop: int | None = None, max_size: int | None = None
+    ) -> bytes:
+        """
+        Encode the blocks at heights [start, stop) of the chain, by default
+        all of them, as encode_blocks would.
+
+        arguments:
+        start -- height of the first block to include
+        stop -- height after the last block to include (defaults to the tip)
+        max_size -- if set, only the blocks from start on that fit in this
+                    many bytes are included
+        """
+        self.sync()
+        stop = len(self.ends) if stop is None else min(stop, len(self.ends))
+        start = min(start, stop)
+        begin = self.ends[start - 1] if start > 0 else 0
+
+        if max_size is not None:
+            stop = bisect.bisect_right(
+                self.ends, begin + max_size - self.overhead(), start, stop)
+
+        end = self.ends[stop - 1] if stop > start else begin
+
+        if self.fmt == JSON_FORMAT:
+            parts = [JSON_PREFIX, b"", JSON_SUFFIX]
+            end = max(begin, end - len(JSON_SEPARATOR))
+        else:
+            envelope = ENVELOPE.pack(MAGIC, CODEC_VERSION, KIND_BLOCKS)
+            parts = [envelope + COUNT.pack(stop - start), b""]
+
+        with memoryview(self.buffer) as view:
+            parts[1] = view[begin:end]
+            return b"".join(parts)
+
+
+class StreamedChain(EncodedChain):
+    def encode(
+        self, start: int = 0, stop: int | None = None, max_size: int | None = None
+    ) -> bytes:
+        """
+        Encode the blocks at heights [start, stop) of the chain, reading them
+        one at a time (see EncodedChain.encode). Unlike EncodedChain, nothing
+        is kept in a buffer, for chains persisted on disk (see
+        store.StoredChain for binary ranges copied from the data file).
+        """
+        stop = len(self.blockchain) if stop is None else min(stop, len(self.blockchain))
+        size = self.overhead()
+        parts = []
+
+        for height in range(start, stop):
+            part = self.encode_one(self.blockchain[height])
+            if max_size is not None and size + len(part) > max_size:
+                break
+            parts.append(part)
+            size += len(part)
+
+        if self.fmt == JSON_FORMAT:
+            body = b"".join(parts)[: -len(JSON_SEPARATOR)] if parts else b""
+            return JSON_PREFIX + body + JSON_SUFFIX
+
+        envelope = ENVELOPE.pack(MAGIC, CODEC_VERSION, KIND_BLOCKS)
+        return envelope + COUNT.pack(len(parts)) + b"".join(parts)
+
+
+if __name__ == "__main__":
+    bc = Blockchain(initialize=False)
+    # start in the past, so the last blocks are not too far in the future
+    genesis = Block(timestamp=int(time.time()) - 1000 * BLOCK_INTERVAL)
+    genesis.hash = genesis.compute_hash()
+    bc.append(genesis)
+
+    for i in range(1000):
+        reviews = [json.dumps({"user": "localhost", "body": "x" * 200}).encode()]
+        new_block = Block(
+            id=i + 1,
+            timestamp=bc.get_last_block().timestamp + BLOCK_INTERVAL,
+            difficulty=bc.next_bits(),
+            merkle_hash=merkle(reviews),
+            prev_hash=bc.get_last_block().hash,
+            data=pack_reviews(reviews),
+        )
+        bc.proof_of_work(new_block)
+        assert bc.add_block(new_block, new_block.compute_hash())
+
+    as_json = encode_blocks(bc.blocks, JSON_FORMAT)
+    as_binary = encode_blocks(bc.blocks, BINARY_FORMAT)
+    print(f"json: {len(as_json)} bytes, binary: {len(as_binary)} bytes")
+
+    new_bc = Blockchain(initialize=False)
+    assert new_bc.load(iter_blocks(as_binary))
+    assert new_bc.to_json() == bc.to_json()
+
+    import io
+    import tracemalloc
+
+    def whole_json():
+        # parse the whole document, then build its blocks
+        for d in json.loads(as_json)["blockchain"]:
+            block = Block()
+            block.from_dict(d)
+            yield block
+
+    # peak memory of decoding the json chain (besides the payload itself)
+    for name, blocks in (
+        ("whole", whole_json),
+        ("streamed", lambda: iter_blocks(as_json)),
+        ("from file", lambda: iter_blocks(io.BytesIO(as_binary))),
+    ):
+        tracemalloc.start()
+        for block in blocks():
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name}: peak {peak} bytes")
+
+    # serving the full chain repeatedly, encoded again each time versus
+    # copied from an EncodedChain
+    for fmt, fmt_name in ((JSON_FORMAT, "json"), (BINARY_FORMAT, "binary")):
+        cached = EncodedChain(bc, fmt)
+        for name, encode in (
+            ("encoded", lambda: encode_blocks(bc.blocks, fmt)),
+            ("cached", cached.encode),
+        ):
+            start_time = time.time()
+            for _ in range(100):
+                encode()
+            elapsed = (time.time() - start_time) * 10
+            print(f"{fmt_name} {name}: {elapsed:.2f}ms per chain")
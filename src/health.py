@@ -0,0 +1,170 @@
+#
+# Columbia University - CSEE 4119 Computer Network
+# Final Project
+#
+# health.py -
+#
+
+import os
+import random
+
+# seconds between pings to each peer
+PING_INTERVAL = 5.0
+# seconds after which an unanswered ping counts as lost
+PING_TIMEOUT = 2.0
+# weight of the newest sample in the moving averages of rtt and loss
+EWMA_WEIGHT = 0.25
+# consecutive lost pings after which a peer is considered dead
+MAX_MISSES = 3
+# highest loss rate a peer can have and still be preferred
+MAX_LOSS = 0.5
+
+
+class PeerStats:
+    def __init__(self):
+        """
+        What we measured of a peer.
+        """
+        # exponentially weighted moving averages of the round trip time (in
+        # seconds, None until the first pong) and of the fraction of pings lost
+        self.rtt = None
+        self.loss = 0.0
+        # pings lost in a row
+        self.misses = 0
+        # nonce and time of the ping waiting for a pong, if any
+        self.nonce = None
+        self.sent = 0.0
+
+
+class PeerHealth:
+    def __init__(self):
+        """
+        Track the round trip time and loss rate of each peer, by pinging
+        them, so that the fastest healthy peers can be preferred and the
+        dead ones evicted.
+
+        This class does no I/O: the peer sends the pings it returns and
+        passes on the pongs it receives.
+        """
+        # dict of (ip, port): PeerStats
+        self.stats = {}
+
+    def update(self, peers):
+        """
+        Track exactly the given peers, keeping what we know of the others.
+        """
+        for addr in peers:
+            if addr not in self.stats:
+                self.stats[addr] = PeerStats()
+        for addr in [a for a in self.stats if a not in peers]:
+            del self.stats[addr]
+
+    def pings(self, now: float) -> list[tuple[bytes, tuple]]:
+        """
+        Count the pings that timed out as lost, and start the pings that are
+        due.
+
+        Returns (nonce, addr) of each ping to send.
+        """
+        due = []
+
+        for addr, stats in self.stats.items():
+            if stats.nonce is not None:
+                if now - stats.sent < PING_TIMEOUT:
+                    continue
+                stats.nonce = None
+                stats.misses += 1
+                stats.loss += EWMA_WEIGHT * (1.0 - stats.loss)
+
+            if now - stats.sent >= PING_INTERVAL or stats.misses > 0:
+                stats.nonce = os.urandom(8)
+                stats.sent = now
+                due.append((stats.nonce, addr))
+
+        return due
+
+    def pong(self, addr, nonce: bytes, now: float):
+        """
+        Record the answer to a ping.
+        """
+        stats = self.stats.get(addr)
+        if stats is None or nonce != stats.nonce:
+            return
+
+        rtt = now - stats.sent
+        if stats.rtt is None:
+            stats.rtt = rtt
+        else:
+            stats.rtt += EWMA_WEIGHT * (rtt - stats.rtt)
+        stats.loss -= EWMA_WEIGHT * stats.loss
+        stats.misses = 0
+        stats.nonce = None
+
+    def failed(self, addr):
+        """
+        Record a request to a peer that went unanswered, as a lost ping.
+        """
+        stats = self.stats.get(addr)
+        if stats is not None:
+            stats.misses += 1
+            stats.loss += EWMA_WEIGHT * (1.0 - stats.loss)
+
+    def dead(self) -> list[tuple]:
+        """
+        Peers that missed MAX_MISSES pings in a row.
+        """
+        return [a for a, stats in self.stats.items() if stats.misses >= MAX_MISSES]
+
+    def healthy(self, addr) -> bool:
+        stats = self.stats.get(addr)
+        return stats is None or (stats.misses == 0 and stats.loss <= MAX_LOSS)
+
+    def score(self, addr) -> float:
+        """
+        Expected time for a request to the peer to be answered: its rtt,
+        inflated by its loss rate. Peers not measured yet are assumed as
+        slow as a ping timeout.
+        """
+        stats = self.stats.get(addr)
+        if stats is None or stats.rtt is None:
+            rtt = PING_TIMEOUT
+        else:
+            rtt = stats.rtt
+        loss = 0.0 if stats is None else min(stats.loss, 0.99)
+        return rtt / (1.0 - loss)
+
+    def ranked(self, peers) -> list[tuple]:
+        """
+        Peers sorted from the fastest healthy one to the slowest unhealthy
+        one (ties broken at random).
+        """
+        peers = list(peers)
+        random.shuffle(peers)
+        return sorted(peers, key=lambda a: (not self.healthy(a), self.score(a)))
+
+    def best(self, peers):
+        """
+        The fastest healthy peer, or None if there are no peers.
+        """
+        ranked = self.ranked(peers)
+        return ranked[0] if ranked else None
+
+
+if __name__ == "__main__":
+    # a fast, a slow and a dead peer, pinged for a minute of simulated time
+    health = PeerHealth()
+    delays = {("fast", 1): 0.01, ("slow", 1): 0.3, ("dead", 1): None}
+    health.update(delays)
+
+    now = 0.0
+    while now < 60:
+        for nonce, addr in health.pings(now):
+            if delays[addr] is not None:
+                health.pong(addr, nonce, now + delays[addr] * random.uniform(0.5, 1.5))
+        now += 1
+
+    for addr in health.ranked(delays):
+        stats = health.stats[addr]
+        rtt = "-" if stats.rtt is None else f"{stats.rtt * 1000:.0f}ms"
+        print(f"{addr[0]}: rtt {rtt}, loss {stats.loss:.2f}, healthy {health.healthy(addr)}")
+    print("dead:", health.dead())
@@ -0,0 +1,237 @@
+#
+# Columbia University - CSEE 4119 Computer Network
+# Final Project
+#
+# mempool.py -
+#
+
+import math
+import time
+import asyncio
+import hashlib
+import collections
+from blockchain import *
+
+# largest amount of review data packed into one block, in bytes
+MAX_BLOCK_SIZE = 512 * 1024
+# longest a review waits for its block to be cut, in seconds
+MAX_BATCH_DELAY = 2.0
+# time constant of the arrival rate estimate, in seconds
+RATE_WINDOW = 10.0
+# bytes pack_reviews adds per review (separator)
+REVIEW_OVERHEAD = len(DATA_SEPARATOR)
+
+
+class Mempool:
+    def __init__(
+        self,
+        blockchain: Blockchain,
+        block_interval: int = BLOCK_INTERVAL,
+        max_block_size: int = MAX_BLOCK_SIZE,
+        max_delay: float = MAX_BATCH_DELAY,
+    ):
+        """
+        Reviews waiting to be mined, in arrival order.
+
+        Reviews are deduplicated by their merkle leaf hash, against both the
+        pool and the chain. A batch is cut once the reviews waiting would
+        fill max_block_size, once there are as many as arrive in a block
+        interval (at least one), or once the oldest has waited max_delay.
+        When reviews arrive slowly, each one is mined right away, and under
+        a burst they are gathered into a few large blocks.
+
+        arguments:
+        blockchain -- the chain, to reject reviews it already includes
+        block_interval -- seconds between blocks the difficulty aims for
+        max_block_size -- largest amount of review data in a batch, in bytes
+        max_delay -- longest a review waits for its batch to be cut
+        """
+        self.blockchain = blockchain
+        self.block_interval = block_interval
+        self.max_block_size = max_block_size
+        self.max_delay = max_delay
+
+        # dict of leaf hash: (review, arrival time), oldest first
+        self.pending = collections.OrderedDict()
+        self.pending_size = 0
+        # leaf hashes of the reviews handed out by next_batch and not yet
+        # returned by done or requeue
+        self.in_flight = set()
+
+        # exponentially decayed count of arrivals, see rate
+        self.arrivals = 0.0
+        self.last_arrival = time.time()
+
+        # set whenever a review is added
+        self.event = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def is_confirmed(self, leaf: bytes) -> bool:
+        """
+        Whether the review with this leaf hash is in a block of the chain.
+        """
+        return leaf in self.blockchain.review_index
+
+    def add(self, review: bytes) -> bool:
+        """
+        Add a review received from a client.
+
+        Returns False if it is a duplicate, already in the chain, or too
+        large for a block.
+        """
+        leaf = hashlib.sha256(review).digest()
+        if (
+            leaf in self.pending
+            or leaf in self.in_flight
+            or len(review) + REVIEW_OVERHEAD > self.max_block_size
+            or self.is_confirmed(leaf)
+        ):
+            return False
+
+        now = time.time()
+        self.arrivals = (
+            self.arrivals * math.exp(-(now - self.last_arrival) / RATE_WINDOW) + 1
+        )
+        self.last_arrival = now
+
+        self.pending[leaf] = (review, now)
+        self.pending_size += len(review) + REVIEW_OVERHEAD
+        self.event.set()
+        return True
+
+    def rate(self) -> float:
+        """
+        Estimated number of reviews arriving per second.
+        """
+        decay = math.exp(-(time.time() - self.last_arrival) / RATE_WINDOW)
+        return self.arrivals * decay / RATE_WINDOW
+
+    def batch_target(self) -> int:
+        """
+        Number of waiting reviews that cuts a batch: about as many as arrive
+        in a block interval.
+        """
+        return max(1, round(self.rate() * self.block_interval))
+
+    def drop_confirmed(self):
+        """
+        Drop the waiting reviews that received blocks already include.
+        """
+        for leaf in [leaf for leaf in self.pending if self.is_confirmed(leaf)]:
+            review, _ = self.pending.pop(leaf)
+            self.pending_size -= len(review) + REVIEW_OVERHEAD
+
+    def deadline(self) -> float | None:
+        """
+        Time at which the oldest waiting review forces a batch to be cut.
+        """
+        if not self.pending:
+            return None
+        _, arrival = next(iter(self.pending.values()))
+        return arrival + self.max_delay
+
+    def ready(self) -> bool:
+        return bool(self.pending) and (
+            self.pending_size >= self.max_block_size
+            or len(self.pending) >= self.batch_target()
+            or time.time() >= self.deadline()
+        )
+
+    def cut(self) -> list[bytes]:
+        """
+        Take the oldest waiting reviews that fit in a block.
+        """
+        reviews = []
+        size = 0
+
+        while self.pending:
+            leaf, (review, _) = next(iter(self.pending.items()))
+            if reviews and size + len(review) + REVIEW_OVERHEAD > self.max_block_size:
+                break
+
+            del self.pending[leaf]
+            self.in_flight.add(leaf)
+            size += len(review) + REVIEW_OVERHEAD
+            reviews.append(review)
+
+        self.pending_size -= size
+        return reviews
+
+    async def next_batch(self) -> list[bytes]:
+        """
+        Wait until a batch should be cut (see __init__) and return it. Its
+        reviews stay in flight until passed to done or requeue.
+        """
+        while True:
+            self.drop_confirmed()
+            if self.ready():
+                return self.cut()
+
+            self.event.clear()
+            deadline = self.deadline()
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def done(self, reviews: list[bytes]):
+        """
+        Forget a batch once its block is in the chain.
+        """
+        for review in reviews:
+            self.in_flight.discard(hashlib.sha256(review).digest())
+
+    def requeue(self, reviews: list[bytes]):
+        """
+        Put reviews back in front of the pool, e.g. those of a block that was
+        not mined or lost a fork, except those the chain already includes.
+        They keep their place ahead of newer reviews, and are due at once.
+        """
+        now = time.time() - self.max_delay
+
+        for review in reversed(reviews):
+            leaf = hashlib.sha256(review).digest()
+            self.in_flight.discard(leaf)
+            if leaf in self.pending or self.is_confirmed(leaf):
+                continue
+
+            self.pending[leaf] = (review, now)
+            self.pending.move_to_end(leaf, last=False)
+            self.pending_size += len(review) + REVIEW_OVERHEAD
+
+        if self.pending:
+            self.event.set()
+
+
+if __name__ == "__main__":
+
+    async def simulate(burst: int, spacing: float):
+        """
+        Feed reviews at a fixed spacing, and cut batches as a peer whose
+        blocks take a second to mine would.
+        """
+        mempool = Mempool(Blockchain(), block_interval=1, max_delay=0.5)
+        batches = []
+
+        async def feed():
+            for i in range(burst):
+                mempool.add(json.dumps({"user": "u", "body": str(i)}).encode())
+                await asyncio.sleep(spacing)
+
+        async def mine():
+            while sum(batches) < burst:
+                batch = await mempool.next_batch()
+                batches.append(len(batch))
+                await asyncio.sleep(1)
+                mempool.done(batch)
+
+        await asyncio.gather(feed(), mine())
+        return batches
+
+    # a trickle gets one block per review, a burst a few large blocks
+    for burst, spacing in ((5, 1.0), (2000, 0.001)):
+        batches = asyncio.run(simulate(burst, spacing))
+        print(f"{burst} reviews {spacing}s apart: {len(batches)} blocks {batches}")
@@ -0,0 +1,225 @@
+#
+# Columbia University - CSEE 4119 Computer Network
+# Final Project
+#
+# miner.py -
+#
+
+import os
+import time
+import hashlib
+import struct
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# nonce is packed as a uint32, so this is the whole search space per header
+NONCE_SPACE = 1 << 32
+
+# how often (in attempts) a worker checks whether its job was cancelled
+CANCEL_CHECK = 1 << 12
+
+pack_nonce = struct.Struct("!I").pack
+
+# job counter shared with worker processes, set by _init_worker
+_job = None
+
+
+def _init_worker(job):
+    """
+    Store the shared job counter in the worker process.
+    """
+    global _job
+    _job = job
+
+
+def _search(job, prefix, suffix, target, start, stop):
+    """
+    Try every nonce in [start, stop) for the given header, looking for a
+    digest no greater than target (both 32-byte big-endian strings).
+
+    Gives up early once the shared job counter no longer matches job, which
+    means another worker already found a hash or the job was cancelled.
+
+    Returns (nonce, attempts), where nonce is None if nothing was found.
+    """
+    # everything before the nonce is hashed once per chunk
+    midstate = hashlib.sha256(prefix)
+
+    for nonce in range(start, stop):
+        if nonce % CANCEL_CHECK == 0 and _job.value != job:
+            return None, nonce - start
+
+        h = midstate.copy()
+        h.update(pack_nonce(nonce))
+        h.update(suffix)
+        if h.digest() <= target:
+            return nonce, nonce - start + 1
+
+    return None, stop - start
+
+
+class Miner:
+    def __init__(self, workers: int = None, chunk_size: int = 1 << 16):
+        """
+        Initialize a proof-of-work miner backed by a process pool.
+
+        arguments:
+        workers -- number of worker processes (defaults to the cpu count)
+        chunk_size -- number of nonces handed to a worker at a time
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+
+        # spawn so that forking a multi-threaded peer is never an issue
+        self.ctx = multiprocessing.get_context("spawn")
+        self.job = self.ctx.Value("L", 0, lock=False)
+        self.pool = None
+
+        # statistics of the last mined block
+        self.hashes = 0
+        self.elapsed = 0.0
+
+    def start(self):
+        """
+        Start the worker processes ahead of the first block.
+        """
+        if self.pool is None and self.workers > 1:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=self.ctx,
+                initializer=_init_worker,
+                initargs=(self.job,),
+            )
+
+    def cancel(self):
+        """
+        Stop every worker currently mining. Safe to call from any thread.
+        """
+        self.job.value += 1
+
+    def new_job(self) -> int:
+        """
+        Reserve the job number for the next call to mine. Any cancel after
+        this stops that call, even if it has not started yet.
+        """
+        self.job.value += 1
+        return self.job.value
+
+    def hashrate(self) -> float:
+        """
+        Hashes per second achieved while mining the last block.
+        """
+        return self.hashes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def mine(self, block, job: int = None) -> bool:
+        """
+        Search for a nonce that satisfies block.target(), splitting the
+        nonce space across the worker pool.
+
+        Once all 2^32 nonces of a header are exhausted, the timestamp is rolled
+        forward by one second and the search restarts on the new header.
+
+        arguments:
+        block -- the block template to mine
+        job -- job number from new_job (a new one if None)
+
+        Returns whether a valid nonce was found (False if cancelled).
+        """
+        if job is None:
+            job = self.new_job()
+        self.hashes = 0
+        start_time = time.time()
+
+        try:
+            while self.job.value == job:
+                nonce = self.search_header(block, job)
+
+                if nonce is not None:
+                    block.nonce = nonce
+                    return True
+
+                if self.job.value == job:
+                    # nonce space exhausted, roll the timestamp instead
+                    block.timestamp += 1
+
+            return False
+        finally:
+            self.elapsed = time.time() - start_time
+
+    def search_header(self, block, job: int) -> int | None:
+        """
+        Search the full nonce space of the block's current header.
+        """
+        prefix, suffix = block.header_parts()
+        args = (job, prefix, suffix, block.target_bytes())
+        chunks = range(0, NONCE_SPACE, self.chunk_size)
+
+        if self.workers == 1:
+            _init_worker(self.job)
+            for start in chunks:
+                nonce, attempts = _search(
+                    *args, start, min(start + self.chunk_size, NONCE_SPACE))
+                self.hashes += attempts
+                if nonce is not None or self.job.value != job:
+                    return nonce
+            return None
+
+        self.start()
+        chunks = iter(chunks)
+        pending = set()
+
+        try:
+            while True:
+                # keep every worker busy with two chunks in flight
+                while len(pending) < 2 * self.workers:
+                    start = next(chunks, None)
+                    if start is None:
+                        break
+                    stop = min(start + self.chunk_size, NONCE_SPACE)
+                    pending.add(self.pool.submit(_search, *args, start, stop))
+
+                if not pending:
+                    return None
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    nonce, attempts = future.result()
+                    self.hashes += attempts
+                    if nonce is not None:
+                        return nonce
+
+                if self.job.value != job:
+                    return None
+        finally:
+            if pending:
+                # tell the remaining workers to give up on this header
+                self.cancel()
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        """
+        Shut down the worker processes.
+        """
+        if self.pool is not None:
+            self.cancel()
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+
+if __name__ == "__main__":
+    from blockchain import Block, target_to_bits, zeros_to_target
+
+    # benchmark hashes/sec for sizing hardware
+    for workers in sorted({1, os.cpu_count() or 1}):
+        miner = Miner(workers=workers)
+        block = Block(
+            id=1, difficulty=target_to_bits(zeros_to_target(5)), data=b"benchmark"
+        )
+        miner.mine(block)
+        print(
+            f"{workers} worker(s): nonce {block.nonce} in {miner.elapsed:.2f}s"
+            f" ({miner.hashrate():,.0f} H/s)"
+        )
+        miner.close()
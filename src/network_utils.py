@@ -6,6 +6,16 @@
 #
 
 import socket
+import struct
+
+# kinds of peer list updates the tracker sends to peers
+SNAPSHOT = 0  # the whole list
+DELTA = 1  # the peers added and removed since the previous version
+
+# kind, version of the list, number of peers in the network
+UPDATE_HEADER = struct.Struct("!BQI")
+# separates added from removed peers in a DELTA
+DELTA_SEPARATOR = b"|"
 
 
 def recvall(sock, size):
@@ -29,5 +39,93 @@ def recvall(sock, size):
     return b"".join(chunks)
 
 
+def encode_addrs(addrs) -> bytes:
+    """
+    Encode (ip, port) addresses as "ip:port;ip:port".
+    """
+    return ";".join(f"{a[0]}:{a[1]}" for a in addrs).encode()
+
+
+def addr_size(addr) -> int:
+    """
+    Bytes an address takes in encode_addrs, including its separator.
+    """
+    return len(f"{addr[0]}:{addr[1]}") + 1
+
+
+def snapshot_size(addrs_size: int) -> int:
+    """
+    Bytes of a framed SNAPSHOT whose addresses take addrs_size bytes
+    (the sum of their addr_size).
+    """
+    return 4 + UPDATE_HEADER.size + max(0, addrs_size - 1)
+
+
+def decode_addrs(data: bytes) -> list[tuple[str, int]]:
+    """
+    Decode "ip:port;ip:port" into (ip, port) addresses.
+
+    Raises ValueError if malformed.
+    """
+    if not data:
+        return []
+
+    addrs = []
+    for a in data.decode().split(";"):
+        ip, port = a.rsplit(":", 1)
+        addrs.append((ip, int(port)))
+    return addrs
+
+
+def frame(payload: bytes) -> bytes:
+    """
+    Prefix a message sent over a stream with its 4-byte length.
+    """
+    return struct.pack("!I", len(payload)) + payload
+
+
+def encode_snapshot(version: int, network_size: int, addrs) -> bytes:
+    """
+    Framed SNAPSHOT update: the whole peer list at a version.
+    """
+    return frame(
+        UPDATE_HEADER.pack(SNAPSHOT, version, network_size) + encode_addrs(addrs)
+    )
+
+
+def encode_delta(version: int, network_size: int, joined, left) -> bytes:
+    """
+    Framed DELTA update, turning the peer list of version - 1 into that of
+    version.
+    """
+    return frame(
+        UPDATE_HEADER.pack(DELTA, version, network_size)
+        + encode_addrs(joined)
+        + DELTA_SEPARATOR
+        + encode_addrs(left)
+    )
+
+
+def decode_update(payload: bytes) -> tuple[int, int, int, list, list]:
+    """
+    Decode an (unframed) peer list update.
+
+    Returns (kind, version, network size, joined, left), where joined is the
+    whole list for a SNAPSHOT. Raises ValueError if malformed.
+    """
+    try:
+        kind, version, network_size = UPDATE_HEADER.unpack_from(payload)
+    except struct.error:
+        raise ValueError("truncated peer list update")
+    body = payload[UPDATE_HEADER.size:]
+
+    if kind == SNAPSHOT:
+        return kind, version, network_size, decode_addrs(body), []
+    if kind == DELTA:
+        joined, _, left = body.partition(DELTA_SEPARATOR)
+        return kind, version, network_size, decode_addrs(joined), decode_addrs(left)
+    raise ValueError("unknown peer list update")
+
+
 if __name__ == "__main__":
     pass
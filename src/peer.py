@@ -7,18 +7,84 @@
 
 import socket
 import argparse
-import threading
+import asyncio
 import errno
-import sys
 import signal
 import random
-from queue import Queue
 from blockchain import *
 from network_utils import *
+from miner import Miner
+from codec import *
+from store import ChainStore, StoredChain
+from mempool import Mempool
+from health import PeerHealth, PING_TIMEOUT
+from bootstrap import RangeDownload, verify_headers, HEADERS_TIMEOUT
+from transport import DatagramEndpoint, MAX_MESSAGE
+
+# largest number of blocks sent in response to a single sync request
+MAX_SYNC_BLOCKS = 500
+# largest encoded chain sent in one message (after the 4-byte type): sync
+# and chain replies are cut to the blocks that fit, and the requester asks
+# for the rest
+MAX_REPLY_SIZE = MAX_MESSAGE - 4
+
+# number of random peers a new block is announced to
+GOSSIP_FANOUT = 8
+# largest number of block hashes in an inv or getdata message
+MAX_INV = 500
+# seconds before a block requested with getdata is requested again, from
+# whichever peer announces it next
+GETDATA_TIMEOUT = 5.0
+# seconds between checks of our peers' health (see health.py)
+HEALTH_INTERVAL = 1.0
+# seconds before reconnecting to the tracker, doubled after every failed
+# attempt up to the maximum
+TRACKER_RETRY = 1.0
+MAX_TRACKER_RETRY = 30.0
+# seconds before a handler that failed is restarted (see supervise)
+HANDLER_RESTART = 1.0
+# checkpoints shipped with the peer, as height: block hash, for the network
+# it is deployed on (each network starts from its own genesis block)
+CHECKPOINTS = {}
+
+
+def parse_checkpoint(value: str) -> tuple[int, bytes]:
+    """
+    Parse a "height:hash" command line checkpoint.
+    """
+    try:
+        height, block_hash = value.split(":")
+        height, block_hash = int(height), bytes.fromhex(block_hash)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected height:hash")
+
+    if height < 0 or len(block_hash) != 32:
+        raise argparse.ArgumentTypeError("expected height:hash")
+    return height, block_hash
+
+
+def split_hashes(payload: bytes) -> list[bytes]:
+    """
+    Split an inv or getdata payload into its (at most MAX_INV) block hashes.
+    """
+    count = min(len(payload) // 32, MAX_INV)
+    return [payload[i * 32: (i + 1) * 32] for i in range(count)]
 
 
 class Peer:
-    def __init__(self, tracker_ip, tracker_port, recv_port):
+    def __init__(
+        self,
+        tracker_ip,
+        tracker_port,
+        recv_port,
+        workers=None,
+        block_interval=BLOCK_INTERVAL,
+        wire_format=BINARY_FORMAT,
+        datadir=None,
+        checkpoints=None,
+        reverify=False,
+        verbose=False,
+    ):
         """
         Initialize Peer.
 
@@ -26,17 +92,66 @@ class Peer:
         tracker_ip -- ip of tracker server
         tracker_port -- port of tracker server
         recv_port -- port of peer server to receive messages
+        workers -- number of mining processes (defaults to the cpu count)
+        block_interval -- seconds between blocks that difficulty aims for
+        wire_format -- encoding for blocks we send (BINARY_FORMAT/JSON_FORMAT)
+        datadir -- directory to persist the chain in (in memory only if None)
+        checkpoints -- dict of height: block hash, on top of CHECKPOINTS
+        reverify -- whether to fully verify assumed valid blocks in the
+                    background (see Blockchain.assume_valid)
+        verbose -- whether to print each new block in full
         """
         self.tracker_ip = tracker_ip
         self.tracker_port = tracker_port
 
         self.chain = None
-        self.peerlist = []
-        self.message_queue = Queue()
-        self.send_queue = Queue()
-        self.data_queue = Queue()
-        self.blockchain = Blockchain(initialize=False)
-        self.reviews_per_block = 1
+        # (ip, port) of the peers the tracker sampled for us, as dict keys
+        self.peerlist = {}
+        # version of the peer list, None until the first snapshot
+        self.peer_version = None
+        # number of peers in the whole network (including us)
+        self.network_size = 1
+        # rtt and loss rate of each peer
+        self.health = PeerHealth()
+        self.send_queue = asyncio.Queue()
+        self.block_interval = block_interval
+        self.wire_format = wire_format
+        self.store = ChainStore(datadir) if datadir else None
+        self.blockchain = Blockchain(
+            initialize=False,
+            block_interval=block_interval,
+            store=self.store,
+            checkpoints={**CHECKPOINTS, **(checkpoints or {})},
+        )
+        self.reverify = reverify
+        self.verbose = verbose
+        # the chain as we send it, in each format, and its headers (see
+        # EncodedChain). A chain on disk is sent from there, so memory does
+        # not grow with it
+        if self.store is None:
+            self.encoded = {
+                JSON_FORMAT: EncodedChain(self.blockchain, JSON_FORMAT),
+                BINARY_FORMAT: EncodedChain(self.blockchain, BINARY_FORMAT),
+            }
+            self.encoded_headers = EncodedChain(
+                self.blockchain, JSON_FORMAT, headers=True)
+        else:
+            self.encoded = {
+                JSON_FORMAT: StreamedChain(self.blockchain, JSON_FORMAT),
+                BINARY_FORMAT: StoredChain(self.store),
+            }
+            self.encoded_headers = StreamedChain(
+                self.blockchain, JSON_FORMAT, headers=True)
+        # background verification of assumed valid blocks, if running
+        self.reverify_task = None
+        self.mempool = Mempool(self.blockchain, block_interval)
+        self.miner = Miner(workers)
+        # block being mined, if any
+        self.template = None
+        # dict of block hash: time it was requested with getdata
+        self.requested = {}
+        # peers whose headers led to invalid blocks while bootstrapping
+        self.invalid_headers = set()
 
         self.ip = socket.gethostbyname(socket.gethostname())
         self.port = recv_port
@@ -49,227 +164,789 @@ class Peer:
                 print("Port is already in use")
                 exit(1)
 
+        # set up in run, once the event loop is running
+        self.endpoint = None
+        self.tracker_reader = None
+        self.tracker_writer = None
+
     #### TCP implementation ####
-    def recv_peerlist(self):
+    async def recv_peerlist(self):
+        """
+        Wait to receive a peer list update and apply it: a snapshot replaces
+        the list, a delta adds and removes the peers that changed. If a delta
+        does not follow our version, we missed one and ask the tracker for a
+        snapshot.
+
+        The list is a bounded random sample of the network (see tracker.py),
+        which we ask to grow if it gets smaller than our gossip fan-out.
+        """
+        nbytes = int.from_bytes(
+            await self.tracker_reader.readexactly(4), byteorder="big")
+        msg = await self.tracker_reader.readexactly(nbytes)
+
+        try:
+            kind, version, network_size, joined, left = decode_update(msg)
+        except ValueError:
+            print("Invalid peer list received.")
+            return
+
+        if kind == SNAPSHOT:
+            self.peerlist = dict.fromkeys(joined)
+        elif self.peer_version is not None and version == self.peer_version + 1:
+            for addr_port in joined:
+                self.peerlist[addr_port] = None
+            for addr_port in left:
+                self.peerlist.pop(addr_port, None)
+        else:
+            if self.peer_version is not None:
+                self.request_peers(0)
+                self.peer_version = None
+            return
+
+        self.peer_version = version
+        self.network_size = network_size
+
+        missing = GOSSIP_FANOUT - len(self.peerlist)
+        if missing > 0 and network_size - 1 > len(self.peerlist):
+            self.request_peers(missing)
+
+    def request_peers(self, count: int):
         """
-        Wait to receive a peer list and parse.
+        Ask the tracker for count more peers, or a snapshot of our peer list
+        if count is 0. Dropped while we are not connected, since the tracker
+        sends a snapshot once we reconnect.
         """
-        nbytes = int.from_bytes(recvall(self.tracker_sock, 4), byteorder="big")
-        msg = recvall(self.tracker_sock, nbytes).decode()
+        if self.tracker_writer is not None and not self.tracker_writer.is_closing():
+            self.tracker_writer.write(count.to_bytes(4, byteorder="big"))
 
-        # List of (ip, port) of peers
-        peers = [a.split(":") for a in msg.split(";")]
-        self.peerlist = [tuple((p[0], int(p[1]))) for p in peers]
+    async def connect_tracker(self):
+        """
+        Connect to the tracker and register the address we receive on.
+        """
+        self.tracker_reader, self.tracker_writer = await asyncio.open_connection(
+            self.tracker_ip, self.tracker_port
+        )
+        host_addr = f"{self.ip}:{self.port}"
+        self.tracker_writer.write(len(host_addr).to_bytes(4, byteorder="big"))
+        self.tracker_writer.write(host_addr.encode())
+        # the tracker starts over with a snapshot
+        self.peer_version = None
 
     #### TCP implementation ####
-    def connection_thread(self):
+    async def connection_handler(self):
         """
-        Connect to tracker server and handle updated peer lists.
+        Handle updated peer lists from the tracker. If the connection is
+        lost, we keep serving our chain to the peers we know, and reconnect
+        with exponential backoff.
         """
         while True:
-            self.recv_peerlist()
+            try:
+                await self.recv_peerlist()
+                continue
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                print(f"Lost connection to the tracker: {e!r}")
+            self.tracker_writer.close()
 
-    #### UDP implementation ####
-    def recv_handler(self, sock):
-        """
-        receiver handler thread/function
+            delay = TRACKER_RETRY
+            while True:
+                await asyncio.sleep(delay)
+                try:
+                    await self.connect_tracker()
+                    print("Reconnected to the tracker")
+                    break
+                except OSError as e:
+                    print(f"Cannot reach the tracker: {e!r}")
+                    delay = min(2 * delay, MAX_TRACKER_RETRY)
 
-        Each message has the format:
-        length (not saved)   - 4 bytes
-        message type (saved) - 4 bytes
-        message (saved)      - (length - 4) bytes
+    async def supervise(self, handler):
+        """
+        Run a handler, restarting it if it fails, so that one handler's
+        error does not stop the others (see run).
         """
         while True:
-            msg_len, addr = sock.recvfrom(4)
-            message, addr = sock.recvfrom(
-                int.from_bytes(msg_len, byteorder="big"))
-            self.message_queue.put((message, addr))
+            try:
+                await handler()
+                return
+            except Exception as e:
+                print(f"{handler.__name__} failed, restarting: {e!r}")
+                await asyncio.sleep(HANDLER_RESTART)
 
     #### UDP implementation ####
-    def send_handler(self):
+    async def send_handler(self):
         while True:
-            while self.send_queue.qsize() != 0:
-                # broadcast to all peers
-                msg, addrs = self.send_queue.get()
-
-                for addr_port in addrs:
-                    if addr_port == tuple((self.ip, self.port)):
-                        continue
-                    self.server_sock.sendto(
-                        len(msg).to_bytes(4, byteorder="big"), addr_port
-                    )
-                    self.server_sock.sendto(msg, addr_port)
+            # broadcast to all peers
+            msg, addrs = await self.send_queue.get()
+
+            for addr_port in addrs:
+                if addr_port == tuple((self.ip, self.port)):
+                    continue
+                # one failed send must not stop the others, nor the peer
+                try:
+                    if not self.endpoint.sendto(msg, addr_port):
+                        print(f"Message to {addr_port} too large, not sent")
+                except Exception as e:
+                    print(f"Failed to send to {addr_port}: {e!r}")
 
     #### UDP implementation ####
-    def message_handler(self):
+    async def message_handler(self):
+        """
+        Process received messages, and stop mining once the block being mined
+        is no longer on top of the chain.
         """
-        Procecess buffered messages
+        while True:
+            message, addr = await self.endpoint.recvfrom()
+            # a message we fail to handle is dropped, without stopping the
+            # peer (every handler runs in the same gather, see run)
+            try:
+                await self.handle_message(message, addr)
+            except Exception as e:
+                print(f"Failed to handle message from {addr}: {e!r}")
+            self.start_reverify()
+
+            # reviews of our blocks that lost a fork are mined again
+            for block in self.blockchain.disconnected:
+                self.mempool.requeue(unpack_reviews(block.data) or [])
+            self.blockchain.disconnected.clear()
+
+            if (
+                self.template is not None
+                and self.template.prev_hash != self.blockchain.get_last_block().hash
+            ):
+                self.miner.cancel()
+
+    async def handle_message(self, message, addr):
+        """
+        Process a received message. Received chains are verified without
+        blocking the event loop (see load_blocks), and the next message is
+        only handled once they are accepted.
+
+        Each message has the format:
+        message type - 4 bytes
+        message      - rest of the message
 
         Types of messages can be:
-        0. [Peer/Client] Full blockchain request
+        0. [Peer/Client] Full blockchain request, optionally followed by a
+           1-byte wire format for the reply (json if absent). The reply
+           (like 5 and 9) holds as many blocks as fit in MAX_REPLY_SIZE
         1. [Client] Submission of review
         2. [Peer] Receive new Block
         3. [Peer] Receive entire Blockchain
+        4. [Peer/Client] Headers-only blockchain request (answered with 5)
+        6. [Client] Inclusion proof request for a review hash (answered with 7)
+        8. [Peer] Request for the blocks after a height or a locator,
+           optionally only count of them
+        9. [Peer] Receive the blocks requested with 8
+        10. [Peer] Inv: announcement of new block hashes (32 bytes each)
+        11. [Peer] Getdata: request for the blocks with the given hashes
+            (answered with 2 for each block we have)
+        12. [Peer] Ping with an 8-byte nonce (answered with 13)
+        13. [Peer] Pong, echoing the nonce of a ping
+        """
+        msg_type = int.from_bytes(message[:4], byteorder="big")
+
+        if msg_type == 0:
+            # respond to request for full blockchain, in the format
+            # the requester asked for
+            fmt = message[4] if len(message) > 4 else JSON_FORMAT
+            msg = struct.pack("!I", 3) + self.encoded_chain(fmt).encode(
+                max_size=MAX_REPLY_SIZE)
+            self.send_queue.put_nowait((msg, [addr]))
+
+        elif msg_type == 4:
+            # respond with the chain's headers, for light clients
+            msg = struct.pack("!I", 5) + self.encoded_headers.encode(
+                max_size=MAX_REPLY_SIZE)
+            self.send_queue.put_nowait((msg, [addr]))
+
+        elif msg_type == 6:
+            # respond with the review's block header and merkle path,
+            # or an empty proof if the review is not in the chain
+            proof = self.blockchain.prove_review(message[4:36])
+            data = json.dumps(proof).encode() if proof else b""
+            msg = struct.pack(f"!I{len(data)}s", 7, data)
+            self.send_queue.put_nowait((msg, [addr]))
+
+        elif msg_type == 8:
+            # respond with up to MAX_SYNC_BLOCKS blocks after the
+            # requested height or the last block shared with the
+            # requester's locator
+            try:
+                request = json.loads(message[4:])
+                if "locator" in request:
+                    locator = [bytes.fromhex(h) for h in request["locator"]]
+                    start = self.blockchain.find_fork(locator) + 1
+                else:
+                    start = max(0, int(request["height"]) + 1)
+                count = min(int(request.get("count", MAX_SYNC_BLOCKS)),
+                            MAX_SYNC_BLOCKS)
+                fmt = request.get("format", JSON_FORMAT)
+            except (KeyError, TypeError, ValueError):
+                print("Invalid sync request received.")
+                return
+
+            bc = self.encoded_chain(fmt).encode(
+                start, start + max(0, count), MAX_REPLY_SIZE)
+            msg = struct.pack("!I", 9) + bc
+            self.send_queue.put_nowait((msg, [addr]))
+
+        elif msg_type == 9:
+            # append the missing blocks, keep asking until the peer
+            # has nothing new, and fall back to the full chain if we
+            # turn out to be on a different fork
+            height = len(self.blockchain)
+            blocks = iter_blocks(memoryview(message)[4:])
+            if await self.load_blocks(blocks):
+                if len(self.blockchain) > height:
+                    self.log_chain(height)
+                    self.request_sync(addr)
+            else:
+                self.request_chain(addr)
+
+        elif msg_type == 10:
+            # fetch the announced blocks we neither have nor are already
+            # fetching from another peer
+            now = time.time()
+            wanted = [
+                block_hash
+                for block_hash in split_hashes(message[4:])
+                if not self.blockchain.has_block(block_hash)
+                and now - self.requested.get(block_hash, 0) >= GETDATA_TIMEOUT
+            ]
+            if wanted:
+                self.expire_requests(now)
+                for block_hash in wanted:
+                    self.requested[block_hash] = now
+                msg = struct.pack("!I", 11) + b"".join(wanted)
+                self.send_queue.put_nowait((msg, [addr]))
+
+        elif msg_type == 11:
+            # send the requested blocks, from the chain or a side branch
+            for block_hash in split_hashes(message[4:]):
+                block = self.blockchain.get_block(block_hash)
+                if block is None and block_hash in self.blockchain.branches:
+                    block, _ = self.blockchain.branches[block_hash]
+                if block is None:
+                    continue
+
+                block_data = encode_block(block, self.wire_format)
+                msg = struct.pack(f"!I{len(block_data)}s", 2, block_data)
+                self.send_queue.put_nowait((msg, [addr]))
+
+        elif msg_type == 12:
+            msg = struct.pack("!I", 13) + message[4:12]
+            self.send_queue.put_nowait((msg, [addr]))
+
+        elif msg_type == 13:
+            self.health.pong(addr, message[4:12], time.time())
+
+        elif msg_type == 1:
+            # received new review, store it in canonical form so it
+            # never has to be re-serialized for blocks or merkle trees
+            try:
+                review = json.dumps(json.loads(message[4:])).encode()
+            except ValueError:
+                print("Invalid review received.")
+                return
+
+            if not self.mempool.add(review):
+                print("Duplicate review ignored.")
+            self.send_queue.put_nowait(
+                ((0).to_bytes(4, byteorder="big"), [addr]))
+
+        elif msg_type == 2:
+            # handle new block: it either extends our chain or a side
+            # branch (which we switch to once it has more work), if its
+            # parent is unknown, request the blocks we are missing.
+            # accepted blocks are announced onwards
+            new_block = decode_block(message[4:])
+            if new_block is not None:
+                # simulated loss: testing if choosing longest chain works (type 3)
+                # if new_block.id % 2 == 1:
+                #     return
+
+                proof = new_block.compute_hash()
+                height = len(self.blockchain)
+                self.requested.pop(proof, None)
+                if self.blockchain.has_block(proof):
+                    pass  # already known
+                elif not self.blockchain.has_block(new_block.prev_hash):
+                    self.request_sync(addr)
+                elif self.blockchain.accept_block(new_block, proof):
+                    self.log_chain(height)
+                    self.announce([proof], exclude=addr)
+                else:
+                    print("Invalid block received.")
+
+        elif msg_type == 3:
+            # only the blocks we do not know yet are verified, and we
+            # reorganize onto them if they carry more work than our chain
+            height = len(self.blockchain)
+            if not await self.load_blocks(iter_blocks(memoryview(message)[4:])):
+                print("Invalid blockchain received.")
+            elif len(self.blockchain) > height:
+                # a chain larger than MAX_REPLY_SIZE arrives cut short
+                self.request_sync(addr)
+
+            self.log_chain(height)
+
+    async def load_blocks(self, blocks) -> bool:
+        """
+        Blockchain.load for the event loop: the blocks are decoded, and their
+        verification in the mining processes waited for, in an executor
+        thread a chunk at a time. Only accepting each verified chunk into the
+        chain runs on the event loop.
+
+        arguments:
+        blocks -- iterable of Block, which may raise ValueError if malformed
+
+        Returns whether all blocks were valid.
+        """
+        loop = asyncio.get_running_loop()
+        pool = self.miner.pool
+        checked = None
+
+        try:
+            checked = self.blockchain.check_blocks(blocks, pool)
+            if checked is None:
+                return False
+
+            while chunk := await loop.run_in_executor(
+                None, lambda: list(itertools.islice(checked, VERIFY_CHUNK))
+            ):
+                if not self.blockchain.accept_checked(chunk, pool is not None):
+                    return False
+        except ValueError:
+            return False
+        finally:
+            # cancels the chunks still being verified
+            if checked is not None:
+                checked.close()
+
+        return True
+
+    def encoded_chain(self, fmt: int) -> EncodedChain | StoredChain:
+        """
+        The chain encoded in a requested wire format (binary unless json).
+        """
+        return self.encoded[JSON_FORMAT if fmt == JSON_FORMAT else BINARY_FORMAT]
+
+    def log_chain(self, height: int):
+        """
+        Print our tip, and with --verbose, the blocks the chain gained above
+        height in full.
+        """
+        if self.verbose:
+            for block in self.blockchain[height:]:
+                print(json.dumps(block.to_dict(), indent=2))
+
+        tip = self.blockchain.get_last_block()
+        print(f"Chain at block {tip.id} ({tip.hash.hex()[:16]})")
+
+    def best_peer(self):
+        """
+        Address of the fastest healthy peer other than us, or None if we are
+        alone.
+        """
+        return self.health.best(
+            a for a in self.peerlist if a != (self.ip, self.port))
+
+    def announce(self, hashes: list[bytes], exclude=None):
+        """
+        Send an inv of block hashes to GOSSIP_FANOUT healthy peers, which
+        fetch the blocks they do not have and announce them in turn. Half of
+        them are our fastest peers, and the rest are random, so the gossip
+        still reaches the whole network.
+
+        arguments:
+        hashes -- hashes of the blocks to announce
+        exclude -- address of the peer we got the blocks from, if any
+        """
+        ranked = [
+            addr_port
+            for addr_port in self.health.ranked(self.peerlist)
+            if addr_port != (self.ip, self.port)
+            and addr_port != exclude
+            and self.health.healthy(addr_port)
+        ]
+        fastest = ranked[: GOSSIP_FANOUT // 2]
+        rest = ranked[GOSSIP_FANOUT // 2:]
+        targets = fastest + random.sample(
+            rest, min(GOSSIP_FANOUT - len(fastest), len(rest)))
+        msg = struct.pack("!I", 10) + b"".join(hashes)
+        self.send_queue.put_nowait((msg, targets))
+
+    async def health_handler(self):
+        """
+        Ping our peers, and evict those that stopped answering. The tracker
+        is asked for as many new peers.
         """
         while True:
-            # first check if there are reviews to add to the blockchain
-            self.consume_data()
-
-            # then consume messages in queue
-            while self.message_queue.qsize() != 0:
-                message, addr = self.message_queue.get()
-                msg_type = int.from_bytes(message[:4], byteorder="big")
-
-                if msg_type == 0:
-                    # respond to request for full blockchain
-                    bc = self.blockchain.to_json().encode()
-                    msg = struct.pack(f"!I{len(bc)}s", 3, bc)
-                    self.send_queue.put((msg, [addr]))
-
-                elif msg_type == 1:
-                    # received new review, add to queue
-                    self.data_queue.put(message[4:])
-                    self.send_queue.put(
-                        ((0).to_bytes(4, byteorder="big"), [addr]))
-
-                elif msg_type == 2:
-                    # handle new block, if it can be directly added, do that
-                    # otherwise, send request for entire blockchain
-                    # if it is at the same height and is valid, just ignore it!
-                    new_block = Block()
-                    if new_block.from_dict(json.loads(message[4:])):
-                        # simulated loss: testing if choosing longest chain works (type 3)
-                        # if new_block.id % 2 == 1:
-                        #     continue
-
-                        if new_block.id == self.blockchain.tail.block.id:
-                            pass  # ignore fork
-                        if new_block.id > self.blockchain.tail.block.id + 1:
-                            self.send_queue.put(
-                                ((0).to_bytes(4, byteorder="big"), [addr])
-                            )
-                        elif self.blockchain.add_block(
-                            new_block, new_block.compute_hash()
-                        ):
-                            print(self.blockchain.to_json(2))
-                        else:
-                            print("Invalid block received.")
-
-                elif msg_type == 3:
-                    new_bc = Blockchain(initialize=False)
-                    if new_bc.from_json(message[4:].decode()):
-                        if new_bc.tail.block.id > self.blockchain.tail.block.id:
-                            self.blockchain = new_bc
-
-                        print(self.blockchain.to_json(2))
-
-    def consume_data(self):
-        """
-        This function consumes reviews from the data queue to form new blocks when sufficient reviews are gathered.
+            self.health.update(
+                [a for a in self.peerlist if a != (self.ip, self.port)])
+
+            for nonce, addr in self.health.pings(time.time()):
+                self.send_queue.put_nowait((struct.pack("!I", 12) + nonce, [addr]))
+
+            dead = self.health.dead()
+            for addr in dead:
+                print(f"Evicting unresponsive peer {addr}")
+                self.peerlist.pop(addr, None)
+            if dead and self.network_size - 1 > len(self.peerlist):
+                self.request_peers(len(dead))
+
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def measure_peers(self):
+        """
+        Ping every peer and wait for their pongs (at most PING_TIMEOUT), so
+        that we bootstrap from the fastest one.
+        """
+        self.health.update(
+            [a for a in self.peerlist if a != (self.ip, self.port)])
+        for nonce, addr in self.health.pings(time.time()):
+            self.endpoint.sendto(struct.pack("!I", 12) + nonce, addr)
+
+        deadline = time.time() + PING_TIMEOUT
+        while any(s.nonce is not None for s in self.health.stats.values()):
+            if await self.bootstrap_recv(13, deadline - time.time()) is None:
+                break
+
+    async def bootstrap_recv(self, msg_type: int, timeout: float):
+        """
+        Wait for a message of the given type while bootstrapping, answering
+        pings and recording pongs meanwhile. Other messages are dropped,
+        since we have no chain yet.
+
+        Returns the message and its sender, or None after timeout seconds.
+        """
+        deadline = time.time() + timeout
+
+        while True:
+            try:
+                msg, addr = await asyncio.wait_for(
+                    self.endpoint.recvfrom(), max(0, deadline - time.time()))
+            except asyncio.TimeoutError:
+                return None
+
+            received_type = int.from_bytes(msg[:4], byteorder="big")
+            if received_type in (12, 13):
+                await self.handle_message(msg, addr)
+            if received_type == msg_type:
+                return msg, addr
+
+    async def fetch_headers(self) -> tuple[list[bytes], tuple]:
+        """
+        Request the headers of the chain from our fastest peer, trying the
+        next best one while a peer does not send valid headers within
+        HEADERS_TIMEOUT seconds.
+
+        Returns the hash of the block at each height, and the peer that sent
+        them.
+        """
+        while True:
+            # a peer that did not answer is tried again only once the
+            # others failed too, and one whose headers led to invalid blocks
+            # only if no other peer is left
+            peer = self.health.best(
+                a for a in self.peerlist
+                if a != (self.ip, self.port) and a not in self.invalid_headers
+            ) or self.best_peer()
+            self.endpoint.sendto(struct.pack("!I", 4), peer)
+
+            deadline = time.time() + HEADERS_TIMEOUT
+            while True:
+                received = await self.bootstrap_recv(5, deadline - time.time())
+                if received is None or received[1] == peer:
+                    break
+
+            hashes = None
+            if received is not None:
+                hashes = verify_headers(
+                    memoryview(received[0])[4:], self.block_interval)
+            if hashes is not None:
+                return hashes, peer
+
+            print(f"No valid headers from {peer}")
+            self.health.failed(peer)
+
+    async def bootstrap(self) -> bool:
+        """
+        Download the blockchain headers first: they are small, and their
+        proof-of-work shows which chain to download. The blocks are then
+        requested in ranges (see bootstrap.py) from all our healthy peers at
+        once, fastest first. A range that does not arrive in time or does
+        not match the headers is requested from another peer, and the peer
+        is marked as failed.
+
+        Received blocks are only matched against the headers' hashes. They
+        are verified in order, in batches of at least VERIFY_CHUNK blocks
+        once the ranges before them arrived, with the (still idle) mining
+        processes. Blocks up to the highest checkpoint are gathered first, so
+        they can be assumed valid.
+
+        Returns whether every block was valid. If not, the peer that sent
+        the headers is marked as failed, since the blocks matched its headers,
+        and is no longer asked for headers while other peers are left.
+        """
+        await self.measure_peers()
+        hashes, source = await self.fetch_headers()
+        print(f"Downloading {len(hashes)} blocks")
+
+        download = RangeDownload(hashes, len(self.blockchain))
+        checkpoint = max(self.blockchain.checkpoints, default=0)
+        blocks = []
+
+        while not download.done():
+            now = time.time()
+            for peer in download.expire(now):
+                print(f"Range request to {peer} timed out")
+                self.health.failed(peer)
+
+            ranked = self.health.ranked(
+                a for a in self.peerlist if a != (self.ip, self.port))
+            # unhealthy peers are only used once every peer failed
+            peers = [a for a in ranked if self.health.healthy(a)] or ranked
+            for start, count, peer in download.assign(peers, now):
+                request = json.dumps(
+                    {"height": start - 1, "count": count, "format": self.wire_format}
+                )
+                self.endpoint.sendto(struct.pack("!I", 8) + request.encode(), peer)
+
+            received = await self.bootstrap_recv(9, download.timeout(time.time()))
+            if received is None:
+                continue
+
+            msg, addr = received
+            try:
+                valid = download.receive(
+                    list(iter_blocks(memoryview(msg)[4:])))
+            except ValueError:
+                valid = False
+            if not valid:
+                print(f"Invalid blocks received from {addr}")
+                self.health.failed(addr)
+                download.release(addr)
+                continue
+
+            # blocks are loaded in batches of at least VERIFY_CHUNK, so that
+            # they are verified in the mining processes (see verify_parallel)
+            blocks.extend(download.ready())
+            if blocks and (
+                blocks[-1].id >= checkpoint and len(blocks) >= VERIFY_CHUNK
+                or download.done()
+            ):
+                if not await self.load_blocks(blocks):
+                    print(f"Invalid chain in the headers from {source}")
+                    self.health.failed(source)
+                    self.invalid_headers.add(source)
+                    return False
+                blocks = []
+
+        return True
+
+    def expire_requests(self, now: float):
+        """
+        Forget getdata requests that were never answered.
+        """
+        for block_hash in [
+            h for h, t in self.requested.items() if now - t >= GETDATA_TIMEOUT
+        ]:
+            del self.requested[block_hash]
+
+    def request_sync(self, addr):
+        """
+        Ask a peer for the blocks after the last one we have in common.
+        """
+        locator = [h.hex() for h in self.blockchain.locator()]
+        request = json.dumps({"locator": locator, "format": self.wire_format})
+        msg = struct.pack(f"!I{len(request)}s", 8, request.encode())
+        self.send_queue.put_nowait((msg, [addr]))
+
+    def request_chain(self, addr):
+        """
+        Ask a peer for its entire blockchain.
+        """
+        msg = struct.pack("!IB", 0, self.wire_format)
+        self.send_queue.put_nowait((msg, [addr]))
+
+    def start_reverify(self):
+        """
+        Start verifying newly assumed valid blocks in the background, if
+        enabled and not already running.
+        """
+        if (
+            self.reverify
+            and self.blockchain.assumed_height > 0
+            and (self.reverify_task is None or self.reverify_task.done())
+        ):
+            self.reverify_task = asyncio.create_task(self.reverify_chain())
+
+    async def reverify_chain(self):
+        """
+        Fully verify the assumed valid blocks in an executor thread. If one
+        is invalid, the checkpoints cannot be trusted: they are dropped, the
+        chain is cut before that block, and the rest is downloaded again with
+        full verification.
+        """
+        height = self.blockchain.assumed_height
+        # copied here, since the chain keeps changing on the event loop
+        blocks = self.blockchain[: height + 1]
+
+        invalid = await asyncio.get_running_loop().run_in_executor(
+            None, self.blockchain.reverify, blocks, self.miner.pool
+        )
+
+        if invalid is None:
+            print(f"Verified the assumed valid blocks up to {height}")
+            if self.blockchain.assumed_height == height:
+                self.blockchain.assumed_height = 0
+            return
+
+        print(f"Assumed valid block {invalid} is invalid, dropping checkpoints")
+        self.blockchain.checkpoints = {}
+        self.blockchain.assumed_height = 0
+        self.blockchain.truncate(max(invalid, 1))
+        self.miner.cancel()
+
+        peer = self.best_peer()
+        if peer is not None:
+            self.request_chain(peer)
+
+    def block_template(self, reviews: list[bytes]) -> Block:
+        """
+        Build the next block on top of our current tip, ready to be mined.
+        """
+        tree = MerkleTree(reviews)
+        return Block(
+            id=self.blockchain.get_last_block().id + 1,
+            timestamp=max(
+                int(time.time()), self.blockchain.median_time_past() + 1
+            ),
+            difficulty=self.blockchain.next_bits(),
+            merkle_hash=tree.root(),
+            prev_hash=self.blockchain.get_last_block().hash,
+            data=pack_reviews(reviews),
+        )
+
+    async def mining_handler(self):
+        """
+        This function consumes batches of reviews from the mempool to form new blocks.
         It creates blocks with a proof-of-work mechanism, and if successful, broadcasts them to peers.
         Unsuccessful attempts result in reviews being re-queued.
+
+        Mining runs in an executor thread, so messages keep being handled
+        meanwhile. Once another block extends the chain, message_handler
+        cancels the miner, and the reviews that block did not include are
+        mined again on top of the new tip.
         """
+        loop = asyncio.get_running_loop()
 
-        if self.data_queue.qsize() >= self.reviews_per_block:
-            reviews = [self.data_queue.get()
-                       for _ in range(self.reviews_per_block)]
-            merkle_root = merkle(reviews)
-            data = {"data": [json.loads(r.decode()) for r in reviews]}
-            new_block = Block(
-                id=self.blockchain.tail.block.id + 1,
-                timestamp=int(time.time()),
-                difficulty=len(self.peerlist),
-                merkle_hash=merkle_root,
-                prev_hash=self.blockchain.tail.block.compute_hash(),
-                data=json.dumps(data).encode(),
+        while True:
+            reviews = await self.mempool.next_batch()
+
+            new_block = self.block_template(reviews)
+            self.template = new_block
+            mined = await loop.run_in_executor(
+                None, self.miner.mine, new_block, self.miner.new_job()
+            )
+            self.template = None
+
+            if not mined:
+                print(f"Stopped mining block {new_block.id}, chain moved on")
+                self.mempool.requeue(reviews)
+                continue
+
+            print(
+                f"Mined block {new_block.id} in {self.miner.elapsed:.2f}s "
+                f"({self.miner.hashrate():,.0f} H/s)"
             )
-            self.blockchain.proof_of_work(new_block)
 
             if not self.blockchain.add_block(
                     new_block, new_block.compute_hash()):
                 print("Failed")
-                for r in reviews:
-                    self.data_queue.put(r)
-                return
-
-            print(self.blockchain.to_json(2))
+                self.mempool.requeue(reviews)
+                continue
+            self.mempool.done(reviews)
 
-            block_data = json.dumps(new_block.to_dict()).encode()
-            msg = struct.pack(f"!I{len(block_data)}s", 2, block_data)
+            self.log_chain(new_block.id)
 
-            self.send_queue.put((msg, self.peerlist))
+            self.announce([new_block.hash])
 
-    def run(self):
+    async def run(self):
         """
         Run the peer.
         """
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+        # spin up the mining processes before any other thread is started
+        self.miner.start()
+
+        # messages of any size, fragmented into datagrams (see transport.py)
+        _, self.endpoint = await loop.create_datagram_endpoint(
+            DatagramEndpoint, sock=self.server_sock
+        )
+
         # connect to tracker and get peer list to see if there is already a
         # blockchain
-        self.tracker_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.tracker_sock.connect((self.tracker_ip, self.tracker_port))
-        host_addr = f"{self.ip}:{self.port}"
-        self.tracker_sock.sendall(len(host_addr).to_bytes(4, byteorder="big"))
-        self.tracker_sock.sendall(host_addr.encode())
-        self.recv_peerlist()
+        await self.connect_tracker()
+        while self.peer_version is None:
+            await self.recv_peerlist()
 
-        # choose random peer from list for blockchain besides (itself)
-        if len(self.peerlist) != 1:
-            while True:
-                peer = self.peerlist[random.randint(0, len(self.peerlist) - 2)]
-
-                # request blockchain from peer
-                self.server_sock.sendto(
-                    (4).to_bytes(4, byteorder="big"), peer
-                )  # length
-                self.server_sock.sendto(
-                    (0).to_bytes(4, byteorder="big"), peer
-                )  # request type
-
-                msglen, _ = self.server_sock.recvfrom(4)
-                msg, _ = self.server_sock.recvfrom(
-                    int.from_bytes(msglen, byteorder="big")
-                )
+        # choose random peer from list for blockchain besides (itself),
+        # unless the chain was reopened from disk
+        reopened = len(self.blockchain) > 0
+        if reopened:
+            print(f"Loaded {len(self.blockchain)} blocks from disk")
 
-                if self.blockchain.from_json(msg[4:].decode()):
-                    print(self.blockchain.to_json(2))
-                    break
+        elif self.best_peer() is not None:
+            while not await self.bootstrap():
+                print("Invalid blockchain received, bootstrapping again")
+                self.blockchain.truncate(0)
+            self.log_chain(0)
 
         else:
             self.blockchain.create_genesis_block()
 
-        recv_thread = threading.Thread(
-            target=self.recv_handler, args=(self.server_sock,)
-        )
-        recv_thread.start()
-
-        msg_thread = threading.Thread(target=self.message_handler)
-        msg_thread.start()
+        self.start_reverify()
 
-        send_thread = threading.Thread(target=self.send_handler)
-        send_thread.start()
+        # a reopened chain only needs the blocks mined while we were away,
+        # and a bootstrapped one those mined while we were downloading
+        if self.best_peer() is not None:
+            self.request_sync(self.best_peer())
 
-        # Main thread handles connection to tracker
-        self.connection_thread()
+        try:
+            await asyncio.gather(
+                *(
+                    self.supervise(handler)
+                    for handler in (
+                        self.message_handler,
+                        self.send_handler,
+                        self.mining_handler,
+                        self.connection_handler,
+                        self.health_handler,
+                    )
+                )
+            )
+        finally:
+            # let the executor thread return, so the event loop can shut down
+            self.miner.cancel()
+            if self.reverify_task is not None:
+                self.reverify_task.cancel()
+            self.tracker_writer.close()
 
     def close(self):
         """
         Close the server socket
         """
         print("Shutting down the peer...")
+        self.miner.close()
+        if self.store is not None:
+            self.store.close()
         self.server_sock.close()
-        self.tracker_sock.close()
         print("Peer shut down successfully.")
 
 
-def signal_handler(sig, frame):
-    """
-    Gracefully handle Ctrl+C/Cmd+C user inputs
-    """
-    global peer
-    peer.close()
-    sys.exit(0)
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         prog="peer.py", description="Blockchain peer.")
@@ -286,9 +963,66 @@ if __name__ == "__main__":
         choices=range(49152, 65535),
         metavar="recv_port: (49152 - 65535)",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of mining processes (defaults to the cpu count)",
+    )
+    parser.add_argument(
+        "--block-interval",
+        type=int,
+        default=BLOCK_INTERVAL,
+        help="target seconds between blocks (must match across the network)",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="send blocks and chains as json instead of binary (for debugging)",
+    )
+    parser.add_argument(
+        "--datadir",
+        default=None,
+        help="directory to persist the chain in, reopened on restart",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=parse_checkpoint,
+        action="append",
+        default=[],
+        metavar="HEIGHT:HASH",
+        help="block hash the chain must have at a height, blocks up to it "
+        "are not re-verified when bootstrapping (repeatable)",
+    )
+    parser.add_argument(
+        "--reverify",
+        action="store_true",
+        help="fully verify the blocks below checkpoints in the background",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="print each new block in full (for debugging)",
+    )
     args = parser.parse_args()
 
-    peer = Peer(args.tracker_ip, args.tracker_port, args.recv_port)
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    peer.run()
+    peer = Peer(
+        args.tracker_ip,
+        args.tracker_port,
+        args.recv_port,
+        args.workers,
+        args.block_interval,
+        JSON_FORMAT if args.json else BINARY_FORMAT,
+        args.datadir,
+        dict(args.checkpoint),
+        args.reverify,
+        args.verbose,
+    )
+
+    # Ctrl+C/Cmd+C or SIGTERM cancel the peer, then shut it down gracefully
+    try:
+        asyncio.run(peer.run())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        peer.close()
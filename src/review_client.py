@@ -8,14 +8,19 @@
 import streamlit as st
 import socket
 import time
+import hashlib
 from network_utils import *
 from blockchain import *
+from codec import *
+from transport import Endpoint
 
 # Initialize session state variables if not already set
 if "peerlist" not in st.session_state:
     st.session_state.peerlist = None
     st.session_state.peer = None
     st.session_state.bc = Blockchain(initialize=False)
+    # reviews submitted in this session, as sent to the peer
+    st.session_state.submitted = []
 
 # Set the layout of the Streamlit page to wide
 st.set_page_config(layout="wide")
@@ -53,13 +58,12 @@ with st.form(key="tracker_data"):
 
         tracker_sock.sendall((0).to_bytes(4, byteorder="big"))
         nbytes = int.from_bytes(recvall(tracker_sock, 4), byteorder="big")
-        msg = recvall(tracker_sock, nbytes).decode()
+        msg = recvall(tracker_sock, nbytes)
         tracker_sock.close()
 
         # Parse peer information from tracker response
         if len(msg) != 0:
-            peers = [a.split(":") for a in msg.split(";")]
-            st.session_state.peerlist = [tuple((p[0], int(p[1]))) for p in peers]
+            st.session_state.peerlist = decode_addrs(msg)
 
 # Allow user to select a peer from the list or manually enter peer details
 if st.session_state.peerlist:
@@ -92,6 +96,7 @@ if st.session_state.peer is not None:
     col1, col2 = st.columns(2)
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    endpoint = Endpoint(sock)
 
     with col1:
         st.markdown("### Review Form")
@@ -117,30 +122,55 @@ if st.session_state.peer is not None:
 
                 encoded_msg = json.dumps(data).encode()
 
-                # Sending message length and message itself over UDP
-                sock.sendto(
-                    (8 + len(encoded_msg)).to_bytes(4, byteorder="big"),
-                    st.session_state.peer,
-                )
-                sock.sendto(
+                # Sending message over UDP
+                endpoint.sendto(
                     struct.pack(f"!I{len(encoded_msg)}s", 1, encoded_msg),
                     st.session_state.peer,
                 )
 
-                sock.settimeout(5)
-
                 try:
-                    msglen, _ = sock.recvfrom(4)
-                    msg, _ = sock.recvfrom(
-                        int.from_bytes(msglen, byteorder="big"))
+                    msg, _ = endpoint.recvfrom(timeout=5)
                     if msg is not None:
                         st.success("Success: Review submitted!")
+                        st.session_state.submitted.append(encoded_msg)
                     else:
                         st.error("Error: Empty response!")
                 except socket.timeout:
                     st.error("Error: Socket timed out (invalid peer or busy)!")
 
-                sock.settimeout(None)
+        # Verify submitted reviews with merkle proofs against the headers only
+        st.markdown("### Verify Reviews")
+        verify = st.button("Verify submitted reviews")
+
+        if verify:
+            try:
+                # fetch headers-only chain
+                endpoint.sendto((4).to_bytes(4, byteorder="big"), st.session_state.peer)
+                msg, _ = endpoint.recvfrom(timeout=5)
+
+                headers = Blockchain(initialize=False, headers_only=True)
+                if not headers.from_json(memoryview(msg)[4:]):
+                    st.error("Error: Could not verify block headers!")
+                    headers = None
+
+                for review in st.session_state.submitted if headers else []:
+                    subject = json.loads(review)["subject"]
+
+                    # request inclusion proof for the review's merkle leaf
+                    endpoint.sendto(
+                        struct.pack("!I32s", 6, hashlib.sha256(review).digest()),
+                        st.session_state.peer,
+                    )
+                    msg, _ = endpoint.recvfrom(timeout=5)
+
+                    if len(msg) == 4:
+                        st.warning(f"Not in a block yet: {subject}")
+                    elif headers.verify_review(review, json.loads(msg[4:])):
+                        st.success(f"Verified: {subject}")
+                    else:
+                        st.error(f"Invalid proof: {subject}")
+            except socket.timeout:
+                st.error("Error: Socket timed out (invalid peer or busy)!")
 
     # Blockchain and review display section
     with col2:
@@ -155,42 +185,29 @@ if st.session_state.peer is not None:
         if update_bc:
             st.session_state.bc = Blockchain(initialize=False)
 
-            sock.sendto(
-                (4).to_bytes(4, byteorder="big"), st.session_state.peer)
-            sock.sendto((0).to_bytes(4, byteorder="big"), st.session_state.peer)
-
-            sock.settimeout(5)
+            # request the full chain in the compact binary format
+            endpoint.sendto(struct.pack("!IB", 0, BINARY_FORMAT), st.session_state.peer)
 
             try:
-                msglen, _ = sock.recvfrom(4)
-                msg, _ = sock.recvfrom(int.from_bytes(msglen, byteorder="big"))
+                msg, _ = endpoint.recvfrom(timeout=5)
 
-                if st.session_state.bc.from_json(msg[4:].decode()):
+                if st.session_state.bc.load(iter_blocks(memoryview(msg)[4:])):
                     print("Decoded blockchain successfully.")
                 else:
                     print("Could not decode blockchain.")
             except socket.timeout:
                 st.error("Error: Socket timed out (invalid peer or busy)!")
 
-            sock.settimeout(None)
-
         # Display reviews from the blockchain
         if st.session_state.bc:
-            node = st.session_state.bc.head
-
             review_data = []
 
-            while node is not None:
-                if node.block.id == 0:
-                    node = node.next
-                    continue
-
-                block_data = json.loads(node.block.data.decode())["data"]
+            # skip the genesis block
+            for block in st.session_state.bc[1:]:
+                block_data = json.loads(block.data.decode())["data"]
 
                 for review in block_data:
-                    review_data.append((node.block.to_dict(), review))
-
-                node = node.next
+                    review_data.append((block.to_dict(), review))
 
             review_data.reverse()
 
@@ -204,8 +221,12 @@ if st.session_state.peer is not None:
                 container.markdown(f"**{review['user']}** :gray[· {curtime}]")
                 container.write(f"Rating: {review['rating']}")
                 container.write(review["body"])
+
+                difficulty = metadata["difficulty"]
+                if metadata["version"] >= COMPACT_VERSION:
+                    difficulty = f"0x{difficulty:08x}"
                 container.write(
-                    f":gray[Metadata - Block ID: {metadata['id']} · difficulty: {metadata['difficulty']} · nonce: {metadata['nonce']}]"
+                    f":gray[Metadata - Block ID: {metadata['id']} · difficulty: {difficulty} · nonce: {metadata['nonce']}]"
                 )
 
     st.header("Blockchain")
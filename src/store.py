@@ -0,0 +1,392 @@
+#
+# Columbia University - CSEE 4119 Computer Network
+# Final Project
+#
+# store.py -
+#
+
+import os
+import mmap
+import hashlib
+import time
+import bisect
+import struct
+from blockchain import *
+from codec import (
+    RECORD, ENVELOPE, COUNT, MAGIC, CODEC_VERSION, KIND_BLOCKS,
+    pack_block, unpack_block,
+)
+
+# offset of the block record in the data file, block hash, cumulative work
+INDEX_ENTRY = struct.Struct("!Q32s32s")
+# review (merkle leaf) hash, height of its block, index in the block
+REVIEW_ENTRY = struct.Struct("!32sII")
+
+
+class MappedFile:
+    def __init__(self, path: str):
+        """
+        Open (or create) a file that is appended to with os.write and read
+        through mmap, remapping whenever it has grown past the mapping.
+
+        arguments:
+        path -- path of the file
+        """
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.map = None
+
+    def view(self, end: int) -> memoryview:
+        """
+        Memoryview of the file's first `end` bytes or more. Must be released
+        before the file is remapped.
+        """
+        if self.map is None or len(self.map) < end:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+
+        return memoryview(self.map)
+
+    def append(self, data: bytes):
+        os.pwrite(self.fd, data, self.size)
+        self.size += len(data)
+
+    def truncate(self, size: int):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.ftruncate(self.fd, size)
+        self.size = size
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.fd)
+
+
+class ChainStore:
+    def __init__(
+        self, datadir: str, sync_every: int = 64, sync_interval: float = 1.0
+    ):
+        """
+        Persistent, append-only block storage, usable as a Blockchain's store.
+
+        Blocks are appended to a segment file (blocks.dat) as codec records,
+        and a fixed-size entry per block (offset, hash, cumulative work) is
+        appended to an index file (blocks.idx). Both are read through mmap,
+        so blocks are only decoded when they are accessed and memory use does
+        not grow with the length of the chain. A fixed-size entry per review
+        is appended to a third file (reviews.idx), so the review index can be
+        loaded without decoding every block (see review_index).
+
+        arguments:
+        datadir -- directory holding the two files (created if missing)
+        sync_every -- fsync after this many appended blocks
+        sync_interval -- or once this many seconds passed since the last fsync
+        """
+        os.makedirs(datadir, exist_ok=True)
+        self.data = MappedFile(os.path.join(datadir, "blocks.dat"))
+        self.index = MappedFile(os.path.join(datadir, "blocks.idx"))
+        reviews = os.path.join(datadir, "reviews.idx")
+        # datadirs written before reviews were indexed have no such file
+        indexed = os.path.exists(reviews)
+        self.reviews = MappedFile(reviews)
+
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+        self.recover(indexed)
+
+    def recover(self, indexed: bool = True):
+        """
+        Drop whatever a crash may have left half-written at the tail: a partial
+        index entry, entries whose record is not fully in the data file, and
+        data past the last indexed record.
+
+        The files are only fsynced every sync_every blocks, and the kernel may
+        write their pages in any order meanwhile, so an index entry appended
+        since the last fsync may have reached the disk before its record. The
+        last sync_every records are therefore decoded and checked against the
+        hashes of their index entries, and the chain is cut before the first
+        one that does not match. Their reviews are indexed again, or those of
+        every block if they were not indexed yet.
+        """
+        self.length = self.index.size // INDEX_ENTRY.size
+
+        while self.length > 0 and self.record_end(self.length - 1) is None:
+            self.length -= 1
+
+        start = max(self.length - self.sync_every, 0)
+        for height in range(start, self.length):
+            if not self.valid_record(height):
+                self.length = height
+                break
+
+        end = self.record_end(self.length - 1) if self.length > 0 else 0
+
+        if self.index.size != self.length * INDEX_ENTRY.size:
+            self.index.truncate(self.length * INDEX_ENTRY.size)
+        if self.data.size != end:
+            self.data.truncate(end)
+
+        if not indexed:
+            start = 0
+        self.truncate_reviews(start)
+        for height in range(start, self.length):
+            self.append_reviews(self[height], height)
+
+    def record_end(self, height: int) -> int | None:
+        """
+        Offset after the record at height, or None if it is incomplete.
+        """
+        offset = self.entry(height)[0]
+
+        if offset + RECORD.size > self.data.size:
+            return None
+
+        with self.data.view(offset + RECORD.size) as view:
+            size = RECORD.unpack_from(view, offset)[-1]
+
+        end = offset + RECORD.size + size
+        return end if end <= self.data.size else None
+
+    def valid_record(self, height: int) -> bool:
+        """
+        Whether the record at height is complete and hashes to its index entry.
+        """
+        if self.record_end(height) is None:
+            return False
+
+        try:
+            block = self[height]
+        except ValueError:
+            return False
+        return block.compute_hash() == block.hash
+
+    def entry(self, height: int) -> tuple[int, bytes, bytes]:
+        start = height * INDEX_ENTRY.size
+
+        with self.index.view(start + INDEX_ENTRY.size) as view:
+            return INDEX_ENTRY.unpack_from(view, start)
+
+    def review_entry(self, i: int) -> tuple[bytes, int, int]:
+        start = i * REVIEW_ENTRY.size
+
+        with self.reviews.view(start + REVIEW_ENTRY.size) as view:
+            return REVIEW_ENTRY.unpack_from(view, start)
+
+    def review_index(self) -> dict:
+        """
+        The dict of review (merkle leaf) hash: (block id, index in block) of
+        the chain's reviews, read from reviews.idx.
+        """
+        size = self.reviews.size - self.reviews.size % REVIEW_ENTRY.size
+        if size == 0:
+            return {}
+
+        with self.reviews.view(size) as view, view[:size] as entries:
+            return {
+                leaf: (height, i)
+                for leaf, height, i in REVIEW_ENTRY.iter_unpack(entries)
+            }
+
+    def append_reviews(self, block: Block, height: int, tree: MerkleTree = None):
+        if tree is not None:
+            leaves = tree.levels[0]
+        else:
+            reviews = unpack_reviews(block.data) or []
+            leaves = [hashlib.sha256(review).digest() for review in reviews]
+
+        self.reviews.append(b"".join(
+            REVIEW_ENTRY.pack(leaf, height, i) for i, leaf in enumerate(leaves)))
+
+    def truncate_reviews(self, height: int):
+        """
+        Remove the review entries of the blocks at height and above, which
+        are the last ones since entries are appended in height order.
+        """
+        count = self.reviews.size // REVIEW_ENTRY.size
+        while count > 0 and self.review_entry(count - 1)[1] >= height:
+            count -= 1
+
+        if self.reviews.size != count * REVIEW_ENTRY.size:
+            self.reviews.truncate(count * REVIEW_ENTRY.size)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, height: int | slice) -> Block | list[Block]:
+        """
+        Decode blocks by height, e.g. store[-1] or store[a:b].
+        """
+        if isinstance(height, slice):
+            return [self[h] for h in range(*height.indices(self.length))]
+
+        if height < 0:
+            height += self.length
+        if not 0 <= height < self.length:
+            raise IndexError("block height out of range")
+
+        offset, block_hash, _ = self.entry(height)
+
+        with self.data.view(self.data.size) as view:
+            block, _ = unpack_block(view, offset)
+
+        block.hash = block_hash
+        return block
+
+    def __iter__(self):
+        for height in range(self.length):
+            yield self[height]
+
+    def hash_at(self, height: int) -> bytes:
+        return self.entry(height % self.length)[1]
+
+    def work_at(self, height: int) -> int:
+        return int.from_bytes(self.entry(height % self.length)[2], "big")
+
+    def offset(self, height: int) -> int:
+        """
+        Offset of the record at height in the data file, or its size for the
+        height after the tip.
+        """
+        return self.entry(height)[0] if height < self.length else self.data.size
+
+    def records(self, start: int, stop: int) -> bytes:
+        """
+        The records of the blocks at heights [start, stop), which the data
+        file holds back to back.
+        """
+        begin, end = self.offset(start), self.offset(stop)
+
+        with self.data.view(end) as view:
+            return bytes(view[begin:end])
+
+    def append(self, block: Block, work: int, tree: MerkleTree = None):
+        """
+        Append a verified block with the chain's cumulative work up to it.
+
+        arguments:
+        block -- the block
+        work -- cumulative work of the chain up to the block
+        tree -- the block's merkle tree, if already built
+        """
+        entry = INDEX_ENTRY.pack(self.data.size, block.hash, work.to_bytes(32, "big"))
+
+        # data first, so an index entry only points at a missing record if
+        # the kernel wrote them out of order before a crash (see recover)
+        self.data.append(pack_block(block))
+        self.append_reviews(block, self.length, tree)
+        self.index.append(entry)
+        self.length += 1
+
+        self.unsynced += 1
+        if (
+            self.unsynced >= self.sync_every
+            or time.time() - self.last_sync >= self.sync_interval
+        ):
+            self.sync()
+
+    def truncate(self, height: int):
+        """
+        Remove the blocks at height and above.
+        """
+        if height >= self.length:
+            return
+
+        offset = self.entry(height)[0]
+        self.index.truncate(height * INDEX_ENTRY.size)
+        self.data.truncate(offset)
+        self.truncate_reviews(height)
+        self.length = height
+        self.sync()
+
+    def sync(self):
+        """
+        Flush appended blocks to disk.
+        """
+        self.data.sync()
+        self.reviews.sync()
+        self.index.sync()
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        self.sync()
+        self.data.close()
+        self.reviews.close()
+        self.index.close()
+
+
+class StoredChain:
+    def __init__(self, store: ChainStore):
+        """
+        Binary encoding of a persisted chain (see codec.encode_blocks) for
+        sending it or a range of it. The block records are copied straight
+        from the store's data file, so nothing is kept encoded in memory.
+
+        arguments:
+        store -- the chain's store
+        """
+        self.store = store
+
+    def encode(
+        self, start: int = 0, stop: int | None = None, max_size: int | None = None
+    ) -> bytes:
+        """
+        Encode the blocks at heights [start, stop) of the chain, by default
+        all of them (see codec.EncodedChain.encode).
+        """
+        length = len(self.store)
+        stop = length if stop is None else min(stop, length)
+        start = min(start, stop)
+
+        if max_size is not None:
+            budget = self.store.offset(start) + max_size - ENVELOPE.size - COUNT.size
+            # offset(h) is where the records up to height h - 1 end
+            stop = start + bisect.bisect_right(
+                range(start + 1, stop + 1), budget, key=self.store.offset)
+
+        envelope = ENVELOPE.pack(MAGIC, CODEC_VERSION, KIND_BLOCKS)
+        return envelope + COUNT.pack(stop - start) + self.store.records(start, stop)
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    # append n blocks, then time reopening the store
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    datadir = tempfile.mkdtemp()
+
+    bc = Blockchain(store=ChainStore(datadir), initialize=False)
+    # start in the past, so the last blocks are not too far in the future
+    genesis = Block(timestamp=int(time.time()) - n * BLOCK_INTERVAL)
+    genesis.hash = genesis.compute_hash()
+    bc.append(genesis)
+    for i in range(n):
+        new_block = Block(
+            id=i + 1,
+            timestamp=bc.get_last_block().timestamp + BLOCK_INTERVAL,
+            difficulty=bc.next_bits(),
+            prev_hash=bc.get_last_block().hash,
+        )
+        bc.proof_of_work(new_block)
+        assert bc.add_block(new_block, new_block.compute_hash())
+    tip = bc.get_last_block().hash
+    bc.store.close()
+
+    start_time = time.time()
+    store = ChainStore(datadir)
+    reopened = Blockchain(initialize=False, store=store)
+    elapsed = time.time() - start_time
+
+    assert reopened.get_last_block().hash == tip
+    print(f"Reopened {len(reopened)} blocks in {elapsed * 1000:.2f}ms")
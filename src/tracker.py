@@ -6,32 +6,101 @@
 #
 
 import socket
-import threading
+import selectors
+import random
 import argparse
 import errno
-import struct
 from blockchain import *
 from network_utils import *
 import sys
 import signal
 
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# bytes read from a connection at a time
+RECV_SIZE = 8192
+# longest "ip:port" a new connection may register with
+MAX_REGISTER_SIZE = 64
+# number of peers in the sample each peer is given
+SAMPLE_SIZE = 16
+# largest sample a peer can grow to by asking for more peers
+MAX_SAMPLE_SIZE = 256
+# seconds between reshuffles, and entries of each sample replaced per reshuffle
+RESHUFFLE_INTERVAL = 30.0
+RESHUFFLE_SIZE = 4
+
+
+class Connection:
+    def __init__(self, sock, addr):
+        """
+        State of a connection to a peer or client.
+
+        arguments:
+        sock -- the non-blocking socket
+        addr -- (ip, port) the connection comes from
+        """
+        self.sock = sock
+        self.addr = addr
+        # received bytes not parsed yet, and bytes being sent
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        # whole messages waiting for outbuf to be sent
+        self.backlog: list[bytes] = []
+        self.backlog_size = 0
+        # (ip, recv port) the peer registered, None until then
+        self.recv_addr = None
+        # (ip, recv port) of the peers in its sample, as dict keys
+        self.sample = {}
+        # sum of the sample's addr_size, to size a snapshot without encoding it
+        self.sample_size = 0
+        # version of the sample, incremented with every update sent
+        self.version = 0
+        # dict of (ip, recv port): whether it was added to (or removed from)
+        # the sample since the last update
+        self.changes = {}
+        # whether the peer needs a snapshot instead of the next delta
+        self.needs_snapshot = False
+        # clients are disconnected once their peer list is sent
+        self.close_when_sent = False
+
 
 class Tracker:
     def __init__(self, port):
         """
         Initialize Tracker server.
 
+        All connections are non-blocking and served from a single selectors
+        event loop (epoll on linux), so the tracker holds as many peers as it
+        has file descriptors, without a thread per peer.
+
+        Each peer is given a bounded random sample of the other peers rather
+        than all of them, along with the size of the network. Samples are
+        kept full as peers leave, and partly reshuffled periodically.
+
         arguments:
         port -- port for the tracker server to bind to.
         the dicts here are used later on for logging purposes
         """
         self.port = port
         self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.lock = threading.Lock()
-        # dict of (ip, port): client_sock
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.selector = selectors.DefaultSelector()
+        # dict of (ip, recv port): Connection of registered peers
         self.connections = {}
-        # dict of (ip, bind port): (ip, recv port)
-        self.bind_to_recv = {}
+        # (ip, recv port) of registered peers, and the index of each in the
+        # list, so that random samples and removals take constant time
+        self.members = []
+        self.member_index = {}
+        # dict of (ip, recv port): Connections whose sample includes it
+        self.samplers = {}
+        # Connections with changes to send at the end of the loop iteration
+        self.dirty = set()
+        self.next_reshuffle = time.time() + RESHUFFLE_INTERVAL
+        # cached plain peer list for clients, None once outdated
+        self.client_cache = None
 
         try:
             self.server_sock.bind(("", port))
@@ -40,116 +109,367 @@ class Tracker:
                 print("Port is already in use")
                 exit(1)
 
-        self.server_sock.listen()
+        raise_fd_limit()
+        self.server_sock.listen(socket.SOMAXCONN)
+        self.server_sock.setblocking(False)
+        self.selector.register(self.server_sock, selectors.EVENT_READ)
 
-    def peer_thread(self, client_sock, client_addr):
+    def run(self):
         """
-        Handle new messages from a peer in a separate thread.
-
-        arguments:
-        client_sock -- the socket connected to the peer.
+        Run the tracker server.
         """
-        client_sock.settimeout(5)
+        try:
+            while True:
+                timeout = max(0, self.next_reshuffle - time.time())
+                for key, events in self.selector.select(timeout):
+                    if key.fileobj is self.server_sock:
+                        self.accept()
+                        continue
+
+                    conn = key.data
+                    if conn.sock.fileno() == -1:
+                        # closed while handling an earlier event
+                        continue
+                    if events & selectors.EVENT_READ:
+                        self.read(conn)
+                    if events & selectors.EVENT_WRITE and conn.sock.fileno() != -1:
+                        self.write(conn)
+
+                if time.time() >= self.next_reshuffle:
+                    self.reshuffle()
+                    self.next_reshuffle = time.time() + RESHUFFLE_INTERVAL
+
+                # changes made during the iteration are sent at once
+                self.broadcast()
+        finally:
+            self.close()
 
+    def accept(self):
+        """
+        Accept every pending connection.
+        """
         while True:
-            # wait for request from client
-            # 1. handle request for current list of peers
-            # 2. handle peer leaving, broadcast updated list
             try:
-                msg = recvall(client_sock, 4)
-
-                if not msg:
-                    # remove thread from list and connection
-                    # broadcast to all
-                    del self.connections[self.bind_to_recv[client_addr]]
-                    del self.bind_to_recv[client_addr]
-                    self.broadcast()
-                    break
-            except socket.timeout:
-                pass
+                client_sock, client_addr = self.server_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # out of file descriptors, retried on the next event
+                print(f"Cannot accept connection: {e}")
+                return
 
-            # otherwise handle request
-            self.send_connections([client_sock])
+            client_sock.setblocking(False)
+            conn = Connection(client_sock, client_addr)
+            self.selector.register(client_sock, selectors.EVENT_READ, conn)
 
-        client_sock.close()
-
-    def run(self):
+    def read(self, conn):
         """
-        Run the tracker server.
+        Read from a connection and handle its complete messages.
+
+        Each message is a 4-byte length, followed by that many bytes:
+        - length 0 from a new connection: a client asking for the peer list
+        - from a new connection: the "ip:port" a peer receives messages on
+        - from a registered peer, just the 4 bytes: a number of peers to add
+          to its sample, or 0 to get a snapshot of it (e.g. after missing an
+          update)
         """
-        self.server_sock.settimeout(3)
         try:
-            while True:
+            data = conn.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self.disconnect(conn)
+            return
+
+        conn.inbuf += data
+
+        while len(conn.inbuf) >= 4:
+            msglen = int.from_bytes(conn.inbuf[:4], byteorder="big")
+
+            if conn.recv_addr is not None:
+                del conn.inbuf[:4]
+                if msglen == 0:
+                    conn.needs_snapshot = True
+                    self.dirty.add(conn)
+                else:
+                    self.grow_sample(conn, msglen)
+
+            elif msglen == 0:
+                print("Received client request.")
+                del conn.inbuf[:4]
+                conn.close_when_sent = True
+                self.queue(conn, self.client_peerlist())
+                return
+
+            elif msglen > MAX_REGISTER_SIZE:
+                # not a registration, and its buffer would grow unbounded
+                self.disconnect(conn)
+                return
+
+            elif len(conn.inbuf) >= 4 + msglen:
                 try:
-                    # wait for connection
-                    client_sock, client_addr = self.server_sock.accept()
+                    addr = conn.inbuf[4: 4 + msglen].decode().split(":")
+                    recv_addr = (addr[0], int(addr[1]))
+                except (IndexError, ValueError):
+                    self.disconnect(conn)
+                    return
+                del conn.inbuf[: 4 + msglen]
 
-                    msglen = int.from_bytes(
-                        recvall(client_sock, 4), byteorder="big")
+                self.register(conn, recv_addr)
 
-                    if msglen == 0:
-                        print("Received client request.")
-                        self.send_connections([client_sock])
-                        client_sock.close()
-                        continue
+            else:
+                return
 
-                    addr = recvall(client_sock, msglen).decode().split(":")
-                    # on accepting connection, send current list of connections
-                    # also spin up a new thread to handle this
-                    self.lock.acquire()
-                    self.bind_to_recv[client_addr] = (addr[0], int(addr[1]))
-                    self.connections[(addr[0], int(addr[1]))] = client_sock
-                    threading.Thread(
-                        target=self.peer_thread, args=(
-                            client_sock, client_addr)).start()
-                    self.broadcast()
+    def register(self, conn, recv_addr):
+        """
+        Add a peer to the network: it gets a random sample of the other
+        peers, and joins their samples in turn, so new peers are known.
+        """
+        old = self.connections.get(recv_addr)
+        if old is not None:
+            # a restarted peer registered again before we noticed
+            self.disconnect(old)
 
-                    print(self.connections.keys())
+        conn.recv_addr = recv_addr
+        self.connections[recv_addr] = conn
+        self.member_index[recv_addr] = len(self.members)
+        self.members.append(recv_addr)
+        self.samplers[recv_addr] = set()
+        self.client_cache = None
 
-                    self.lock.release()
+        for addr in self.random_members(SAMPLE_SIZE, conn):
+            self.add_to_sample(conn, addr)
 
-                except socket.timeout:
-                    self.broadcast()
-        finally:
-            self.close()
+            other = self.connections[addr]
+            if len(other.sample) >= SAMPLE_SIZE:
+                self.remove_from_sample(other, random.choice(list(other.sample)))
+            self.add_to_sample(other, recv_addr)
+
+        conn.needs_snapshot = True
+        self.dirty.add(conn)
+        print(f"{recv_addr} joined, {len(self.members)} peers")
+
+    def unregister(self, conn):
+        """
+        Remove a peer from the network, replacing it in the samples that
+        included it.
+        """
+        recv_addr = conn.recv_addr
+        del self.connections[recv_addr]
+
+        # swap with the last member, so removal takes constant time
+        index = self.member_index.pop(recv_addr)
+        last = self.members.pop()
+        if last != recv_addr:
+            self.members[index] = last
+            self.member_index[last] = index
+        self.client_cache = None
+
+        for addr in conn.sample:
+            self.samplers[addr].discard(conn)
+        self.dirty.discard(conn)
+
+        for other in list(self.samplers[recv_addr]):
+            self.remove_from_sample(other, recv_addr)
+            for addr in self.random_members(1, other):
+                self.add_to_sample(other, addr)
+        del self.samplers[recv_addr]
+
+        print(f"{recv_addr} left, {len(self.members)} peers")
+
+    def random_members(self, count: int, conn) -> list:
+        """
+        Up to count random peers, other than conn's peer and its sample.
+        """
+        exclude = len(conn.sample) + 1
+        candidates = random.sample(
+            self.members, min(count + exclude, len(self.members))
+        )
+        return [
+            addr
+            for addr in candidates
+            if addr != conn.recv_addr and addr not in conn.sample
+        ][:count]
+
+    def add_to_sample(self, conn, addr):
+        conn.sample[addr] = None
+        conn.sample_size += addr_size(addr)
+        self.samplers[addr].add(conn)
+        self.record_change(conn, addr, True)
+
+    def remove_from_sample(self, conn, addr):
+        del conn.sample[addr]
+        conn.sample_size -= addr_size(addr)
+        self.samplers[addr].discard(conn)
+        self.record_change(conn, addr, False)
+
+    def record_change(self, conn, addr, added: bool):
+        # an addition and a removal of the same peer cancel out
+        if conn.changes.get(addr, added) != added:
+            del conn.changes[addr]
+        else:
+            conn.changes[addr] = added
+        self.dirty.add(conn)
+
+    def grow_sample(self, conn, count: int):
+        """
+        Add up to count peers to a peer's sample, on its request.
+        """
+        count = min(count, MAX_SAMPLE_SIZE - len(conn.sample))
+        if count > 0:
+            for addr in self.random_members(count, conn):
+                self.add_to_sample(conn, addr)
+
+    def reshuffle(self):
+        """
+        Replace a few random entries of every sample, so that the overlay
+        keeps mixing. Every peer also learns the current network size.
+        """
+        for conn in self.connections.values():
+            for _ in range(min(RESHUFFLE_SIZE, len(conn.sample))):
+                fresh = self.random_members(1, conn)
+                if not fresh:
+                    break
+                self.remove_from_sample(conn, random.choice(list(conn.sample)))
+                self.add_to_sample(conn, fresh[0])
+            self.dirty.add(conn)
+
+    def write(self, conn):
+        """
+        Send as much of a connection's buffered data as the socket takes.
+        """
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.disconnect(conn)
+            return
+
+        del conn.outbuf[:sent]
+        if not conn.outbuf and conn.backlog:
+            conn.outbuf += b"".join(conn.backlog)
+            self.clear_backlog(conn)
+
+        if not conn.outbuf:
+            if conn.close_when_sent:
+                self.disconnect(conn)
+            else:
+                self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def disconnect(self, conn):
+        """
+        Close a connection, and remove its peer from the network.
+        """
+        if conn.sock.fileno() == -1:
+            return
+
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+
+        if self.connections.get(conn.recv_addr) is conn:
+            self.unregister(conn)
 
     def broadcast(self):
         """
-        Send connection list to all peers.
+        Send every peer whose sample changed an update: a delta of the peers
+        added and removed, or a snapshot of the whole sample to newly
+        registered peers. Both carry the size of the network.
+        """
+        dirty, self.dirty = self.dirty, set()
+
+        for conn in dirty:
+            conn.version += 1
+            if conn.needs_snapshot:
+                conn.needs_snapshot = False
+                self.clear_backlog(conn)
+                msg = self.snapshot(conn)
+            else:
+                joined = [a for a, added in conn.changes.items() if added]
+                left = [a for a, added in conn.changes.items() if not added]
+                msg = encode_delta(conn.version, len(self.members), joined, left)
+            conn.changes.clear()
+            self.queue(conn, msg)
+
+    def snapshot(self, conn) -> bytes:
+        """
+        Framed snapshot of a peer's sample, at its current version.
         """
-        self.send_connections(self.connections.values())
+        return encode_snapshot(conn.version, len(self.members), conn.sample)
 
-    def send_connections(self, sock_list):
+    def client_peerlist(self) -> bytes:
         """
-        Only call this function when the connections list is locked.
+        Framed plain list of every peer, as sent to clients.
         """
-        peerlist = ";".join(
-            [f"{a[0]}:{a[1]}" for a in self.connections.keys()]
-        ).encode()
-        msg = struct.pack("!I", len(peerlist)) + peerlist
+        if self.client_cache is None:
+            self.client_cache = frame(encode_addrs(self.members))
+        return self.client_cache
 
-        for sock in sock_list:
-            sock.sendall(msg)
+    def queue(self, conn, msg: bytes):
+        """
+        Send a message on a connection, buffering what the socket does not
+        take right away.
+
+        A peer whose waiting updates would outgrow a snapshot has fallen
+        behind: they are replaced by the snapshot, so what is buffered for a
+        peer never exceeds one sample.
+        """
+        if conn.outbuf:
+            if conn.recv_addr is not None and (
+                conn.backlog_size + len(msg) > snapshot_size(conn.sample_size)
+            ):
+                self.clear_backlog(conn)
+                msg = self.snapshot(conn)
+            conn.backlog.append(msg)
+            conn.backlog_size += len(msg)
+            return
+
+        conn.outbuf += msg
+        self.selector.modify(
+            conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn
+        )
+        self.write(conn)
+
+    def clear_backlog(self, conn):
+        conn.backlog.clear()
+        conn.backlog_size = 0
 
     def close(self):
         """
         Close all client sockets and the server socket.
         """
         print("Shutting down the tracker...")
-        self.lock.acquire()
-        for client_sock in self.connections.values():
-            client_sock.close()
-        self.server_sock.close()
-        self.lock.release()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+        self.connections.clear()
         print("Tracker shut down successfully.")
 
 
+def raise_fd_limit():
+    """
+    Raise the limit on open files to the maximum allowed, since each peer
+    holds a connection.
+    """
+    if resource is None:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
 def signal_handler(sig, frame):
     """
     Gracefully handles user Ctrl+C/Cmd+C input to terminate.
     """
-    global tracker
-    tracker.close()
+    # Tracker.run closes the sockets on the way out
     sys.exit(0)
 
 
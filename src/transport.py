@@ -0,0 +1,530 @@
+#
+# Columbia University - CSEE 4119 Computer Network
+# Final Project
+#
+# transport.py -
+#
+
+import time
+import random
+import asyncio
+import socket
+import struct
+import itertools
+import threading
+
+# kind, message id, fragment index, number of fragments
+FRAGMENT = struct.Struct("!BIHH")
+# index of a missing fragment in a NACK
+NACK_ENTRY = struct.Struct("!H")
+
+# kinds of datagrams
+DATA = 0  # a fragment of a message
+ACK = 1  # the whole message was received
+NACK = 2  # the fragments listed in the payload are missing
+
+# largest datagram that fits an ethernet frame (1500 bytes minus the ip and
+# udp headers), and the largest message payload that fits one
+MAX_DATAGRAM = 1472
+FRAGMENT_SIZE = MAX_DATAGRAM - FRAGMENT.size
+MAX_FRAGMENTS = 0xFFFF
+MAX_NACK_ENTRIES = FRAGMENT_SIZE // NACK_ENTRY.size
+
+# seconds without an ack before the sender probes the receiver again, doubled
+# after every probe, and the number of probes before giving up
+RETRANSMIT_TIMEOUT = 0.5
+MAX_RETRIES = 6
+# seconds without new fragments before the receiver asks for missing ones
+NACK_TIMEOUT = 0.1
+# seconds without new fragments before the receiver gives up on a message
+REASSEMBLY_TIMEOUT = 10.0
+
+# bytes of unacknowledged (sending) and incomplete (receiving) messages kept,
+# the oldest are dropped beyond this
+MAX_BUFFERED = 64 << 20
+# largest message a Transport with the default settings sends or receives:
+# it must fit in MAX_FRAGMENTS, and be reassembled within MAX_BUFFERED
+MAX_MESSAGE = min(MAX_FRAGMENTS, MAX_BUFFERED // FRAGMENT_SIZE) * FRAGMENT_SIZE
+# incomplete messages kept per sender, and in total, the oldest are dropped
+# beyond this
+MAX_INCOMPLETE_PER_SENDER = 4
+MAX_INCOMPLETE = 1024
+# number of delivered message ids remembered to re-ack duplicate fragments
+MAX_DELIVERED = 4096
+
+# kernel buffer size requested for sockets used by an Endpoint
+SOCKET_BUFFER = 4 << 20
+
+
+class Outgoing:
+    def __init__(self, addr, fragments: list[bytes], now: float):
+        """
+        A sent message waiting to be acknowledged.
+
+        arguments:
+        addr -- address of the receiver
+        fragments -- the message's DATA datagrams
+        now -- current time
+        """
+        self.addr = addr
+        self.fragments = fragments
+        self.size = sum(len(f) for f in fragments)
+        self.retries = 0
+        self.deadline = now + RETRANSMIT_TIMEOUT
+
+
+class Incoming:
+    def __init__(self, total: int, now: float):
+        """
+        A message being reassembled.
+
+        arguments:
+        total -- number of fragments of the message
+        now -- current time
+        """
+        self.total = total
+        # dict of fragment index: payload of the received fragments, so that
+        # memory follows what arrived rather than what the sender announced
+        self.fragments: dict[int, bytes] = {}
+        self.missing = total
+        # no fragment below this index is missing
+        self.first_missing = 0
+        self.size = 0
+        self.last_seen = now
+        self.nacked = now
+
+    def add(self, seq: int, payload: bytes):
+        self.fragments[seq] = payload
+        self.missing -= 1
+        self.size += len(payload)
+        while self.first_missing in self.fragments:
+            self.first_missing += 1
+
+    def missing_indexes(self, limit: int) -> list[int]:
+        """
+        Up to limit indexes of missing fragments, lowest first.
+        """
+        indexes = range(self.first_missing, self.total)
+        return list(itertools.islice(
+            itertools.filterfalse(self.fragments.__contains__, indexes), limit))
+
+    def message(self) -> bytes:
+        return b"".join(self.fragments[seq] for seq in range(self.total))
+
+
+class Transport:
+    def __init__(
+        self, fragment_size: int = FRAGMENT_SIZE, max_buffered: int = MAX_BUFFERED
+    ):
+        """
+        Reliable transfer of messages of any size over UDP datagrams.
+
+        Messages are split into sequence-numbered fragments, which the receiver
+        reassembles in whatever order they arrive. Once a message is complete
+        the receiver acks it. Fragments still missing after NACK_TIMEOUT are
+        requested again with a NACK, and a sender that heard nothing after
+        RETRANSMIT_TIMEOUT probes by resending the last fragment.
+
+        This class does no I/O: every method takes the current time and returns
+        the datagrams to send as (datagram, addr) pairs. See Endpoint for a
+        blocking socket wrapper.
+
+        arguments:
+        fragment_size -- largest message payload per datagram
+        max_buffered -- bytes of outgoing and of incoming messages kept
+        """
+        self.fragment_size = fragment_size
+        self.max_buffered = max_buffered
+        # a larger message would be dropped by a receiver with the same
+        # settings, so it is not sent either
+        self.max_fragments = min(MAX_FRAGMENTS, max_buffered // fragment_size)
+        self.max_message = self.max_fragments * fragment_size
+
+        self.next_id = random.getrandbits(32)
+        # dict of message id: Outgoing
+        self.sending = {}
+        self.sending_size = 0
+        # dict of (addr, message id): Incoming, oldest first
+        self.receiving = {}
+        self.receiving_size = 0
+        # dict of addr: {(addr, message id): None} of its incomplete
+        # messages, oldest first
+        self.senders = {}
+        # (addr, message id) of recently delivered messages, oldest first
+        self.delivered = {}
+
+    def send(self, message: bytes, addr, now: float) -> list[tuple[bytes, tuple]]:
+        """
+        Split a message into fragments for addr.
+
+        Raises ValueError if the message is larger than max_message.
+        """
+        total = max(1, -(-len(message) // self.fragment_size))
+        if total > self.max_fragments:
+            raise ValueError("message too large")
+
+        msg_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+
+        view = memoryview(message)
+        fragments = [
+            FRAGMENT.pack(DATA, msg_id, seq, total)
+            + view[seq * self.fragment_size: (seq + 1) * self.fragment_size]
+            for seq in range(total)
+        ]
+
+        outgoing = Outgoing(addr, fragments, now)
+        self.sending[msg_id] = outgoing
+        self.sending_size += outgoing.size
+        while self.sending_size > self.max_buffered and len(self.sending) > 1:
+            self.forget(next(iter(self.sending)))
+
+        return [(f, addr) for f in fragments]
+
+    def forget(self, msg_id: int):
+        """
+        Stop retransmitting a sent message.
+        """
+        outgoing = self.sending.pop(msg_id, None)
+        if outgoing is not None:
+            self.sending_size -= outgoing.size
+
+    def receive(
+        self, datagram: bytes, addr, now: float
+    ) -> tuple[bytes | None, list[tuple[bytes, tuple]]]:
+        """
+        Handle a datagram from addr.
+
+        Returns the message it completed (or None) and the datagrams to send
+        in response.
+        """
+        try:
+            kind, msg_id, seq, total = FRAGMENT.unpack_from(datagram)
+        except struct.error:
+            return None, []
+
+        if kind == ACK:
+            if msg_id in self.sending and self.sending[msg_id].addr == addr:
+                self.forget(msg_id)
+            return None, []
+
+        if kind == NACK:
+            outgoing = self.sending.get(msg_id)
+            if outgoing is None or outgoing.addr != addr:
+                return None, []
+
+            # the receiver is alive, so start the probe timer over
+            outgoing.retries = 0
+            outgoing.deadline = now + RETRANSMIT_TIMEOUT
+            entries = datagram[FRAGMENT.size:]
+            entries = entries[: len(entries) - len(entries) % NACK_ENTRY.size]
+            missing = [
+                outgoing.fragments[s]
+                for (s,) in NACK_ENTRY.iter_unpack(entries)
+                if s < len(outgoing.fragments)
+            ]
+            return None, [(f, addr) for f in missing]
+
+        if kind != DATA or not seq < total:
+            return None, []
+
+        key = (addr, msg_id)
+        ack = [(FRAGMENT.pack(ACK, msg_id, 0, total), addr)]
+
+        if key in self.delivered:
+            # our ack was lost, the sender is still retransmitting
+            return None, ack
+
+        incoming = self.receiving.get(key)
+        if incoming is None:
+            if total > self.max_fragments:
+                return None, []
+
+            pending = self.senders.setdefault(addr, {})
+            while len(pending) >= MAX_INCOMPLETE_PER_SENDER:
+                self.drop(next(iter(pending)))
+            while len(self.receiving) >= MAX_INCOMPLETE:
+                self.drop(next(iter(self.receiving)))
+
+            incoming = Incoming(total, now)
+            self.receiving[key] = incoming
+            self.senders.setdefault(addr, {})[key] = None
+        elif incoming.total != total:
+            return None, []
+
+        incoming.last_seen = now
+        if seq in incoming.fragments:
+            return None, []
+
+        payload = datagram[FRAGMENT.size:]
+        incoming.add(seq, payload)
+        self.receiving_size += len(payload)
+
+        if incoming.missing > 0:
+            while self.receiving_size > self.max_buffered:
+                self.drop(next(iter(self.receiving)))
+            return None, []
+
+        self.drop(key)
+        self.delivered[key] = None
+        if len(self.delivered) > MAX_DELIVERED:
+            del self.delivered[next(iter(self.delivered))]
+
+        return incoming.message(), ack
+
+    def drop(self, key: tuple):
+        """
+        Stop reassembling a message.
+        """
+        incoming = self.receiving.pop(key, None)
+        if incoming is not None:
+            self.receiving_size -= incoming.size
+
+            addr = key[0]
+            pending = self.senders[addr]
+            del pending[key]
+            if not pending:
+                del self.senders[addr]
+
+    def poll(self, now: float) -> list[tuple[bytes, tuple]]:
+        """
+        Handle expired timers: probe receivers that did not ack, ask senders
+        for missing fragments, and drop what timed out for good.
+
+        Returns the datagrams to send.
+        """
+        out = []
+
+        for msg_id, outgoing in list(self.sending.items()):
+            if now < outgoing.deadline:
+                continue
+            if outgoing.retries >= MAX_RETRIES:
+                self.forget(msg_id)
+                continue
+
+            outgoing.retries += 1
+            outgoing.deadline = now + RETRANSMIT_TIMEOUT * 2**outgoing.retries
+            out.append((outgoing.fragments[-1], outgoing.addr))
+
+        for key, incoming in list(self.receiving.items()):
+            if now - incoming.last_seen >= REASSEMBLY_TIMEOUT:
+                self.drop(key)
+                continue
+            if min(now - incoming.last_seen, now - incoming.nacked) < NACK_TIMEOUT:
+                continue
+
+            incoming.nacked = now
+            addr, msg_id = key
+            missing = incoming.missing_indexes(MAX_NACK_ENTRIES)
+            header = FRAGMENT.pack(NACK, msg_id, 0, incoming.total)
+            entries = struct.pack(f"!{len(missing)}H", *missing)
+            out.append((header + entries, addr))
+
+        return out
+
+    def timeout(self, now: float) -> float | None:
+        """
+        Seconds until poll has work to do, or None if nothing is pending.
+        """
+        deadlines = [o.deadline for o in self.sending.values()]
+        deadlines.extend(
+            max(i.last_seen, i.nacked) + NACK_TIMEOUT for i in self.receiving.values()
+        )
+        return max(0.0, min(deadlines) - now) if deadlines else None
+
+
+class Endpoint:
+    def __init__(self, sock: socket.socket, transport: Transport = None):
+        """
+        Blocking, thread-safe sendto/recvfrom of whole messages over a UDP
+        socket, using a Transport. One thread may receive while others send.
+
+        arguments:
+        sock -- a bound (or unbound, for clients) UDP socket
+        transport -- defaults to a new Transport
+        """
+        self.sock = sock
+        self.transport = transport or Transport()
+        self.lock = threading.Lock()
+
+        for opt in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, opt, SOCKET_BUFFER)
+            except OSError:
+                pass
+
+    def flush(self, datagrams: list[tuple[bytes, tuple]]):
+        """
+        Send datagrams, ignoring failures: whatever is lost is retransmitted.
+        """
+        for datagram, addr in datagrams:
+            try:
+                self.sock.sendto(datagram, addr)
+            except OSError:
+                pass
+
+    def sendto(self, message: bytes, addr) -> bool:
+        """
+        Send a message, unless it is larger than the transport's max_message.
+
+        Returns whether the message was sent.
+        """
+        if len(message) > self.transport.max_message:
+            return False
+        with self.lock:
+            out = self.transport.send(message, addr, time.time())
+        self.flush(out)
+        return True
+
+    def recvfrom(self, timeout: float = None) -> tuple[bytes, tuple]:
+        """
+        Wait for the next complete message, running the transport's timers
+        meanwhile.
+
+        Raises socket.timeout if no message completed within timeout seconds
+        (if not None).
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            now = time.time()
+            with self.lock:
+                wait = self.transport.timeout(now)
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+
+            # a zero timeout would make the socket non-blocking for senders
+            self.sock.settimeout(None if wait is None else max(wait, 0.001))
+
+            try:
+                datagram, addr = self.sock.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                datagram = None
+            except ConnectionRefusedError:
+                # icmp error caused by an earlier datagram, not this one
+                continue
+
+            now = time.time()
+            message = None
+            with self.lock:
+                out = self.transport.poll(now)
+                if datagram is not None:
+                    message, more = self.transport.receive(datagram, addr, now)
+                    out.extend(more)
+            self.flush(out)
+
+            if message is not None:
+                return message, addr
+            if deadline is not None and time.time() >= deadline:
+                raise socket.timeout("timed out")
+
+
+class DatagramEndpoint(asyncio.DatagramProtocol):
+    def __init__(self, transport: Transport = None):
+        """
+        asyncio counterpart of Endpoint, to be passed to
+        loop.create_datagram_endpoint. Timers run on the event loop, so
+        nothing here blocks.
+
+        arguments:
+        transport -- defaults to a new Transport
+        """
+        self.transport = transport or Transport()
+        self.udp = None
+        self.messages = asyncio.Queue()
+        self.timer = None
+
+    def connection_made(self, udp):
+        self.udp = udp
+        sock = udp.get_extra_info("socket")
+        for opt in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, opt, SOCKET_BUFFER)
+            except OSError:
+                pass
+
+    def connection_lost(self, exc):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.udp = None
+
+    def error_received(self, exc):
+        # icmp errors caused by earlier datagrams, lost data is retransmitted
+        pass
+
+    def flush(self, datagrams: list[tuple[bytes, tuple]]):
+        if self.udp is None:
+            return
+        for datagram, addr in datagrams:
+            self.udp.sendto(datagram, addr)
+        self.schedule()
+
+    def schedule(self):
+        """
+        (Re)arm the timer for the transport's next deadline.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        wait = self.transport.timeout(time.time())
+        if wait is not None:
+            self.timer = asyncio.get_running_loop().call_later(wait, self.poll)
+
+    def poll(self):
+        self.timer = None
+        self.flush(self.transport.poll(time.time()))
+
+    def datagram_received(self, datagram: bytes, addr):
+        message, out = self.transport.receive(datagram, addr, time.time())
+        if message is not None:
+            self.messages.put_nowait((message, addr))
+        self.flush(out)
+
+    def sendto(self, message: bytes, addr) -> bool:
+        """
+        Send a message, unless it is larger than the transport's max_message.
+
+        Returns whether the message was sent.
+        """
+        if len(message) > self.transport.max_message:
+            return False
+        self.flush(self.transport.send(message, addr, time.time()))
+        return True
+
+    async def recvfrom(self) -> tuple[bytes, tuple]:
+        """
+        Wait for the next complete message.
+        """
+        return await self.messages.get()
+
+
+if __name__ == "__main__":
+    import sys
+
+    # send a message of the given size (in MB) over loopback and time it
+    size = int(float(sys.argv[1]) * (1 << 20)) if len(sys.argv) > 1 else 8 << 20
+    message = random.randbytes(size)
+
+    receiver = Endpoint(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+    receiver.sock.bind(("127.0.0.1", 0))
+    sender = Endpoint(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+    sender.sock.bind(("127.0.0.1", 0))
+
+    # the sender must run its own timers to answer nacks
+    def serve():
+        try:
+            while True:
+                sender.recvfrom()
+        except OSError:
+            pass
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    start_time = time.time()
+    sender.sendto(message, receiver.sock.getsockname())
+    received, _ = receiver.recvfrom(timeout=30)
+    elapsed = time.time() - start_time
+
+    assert received == message
+    print(f"{size / (1 << 20):.1f} MB in {elapsed:.2f}s ({size / elapsed / 1e6:.1f} MB/s)")